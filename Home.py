@@ -1,7 +1,11 @@
 import nltk
 import streamlit as st
 
-nltk.download('stopwords')
+try:
+    # baked into the image (see the Dockerfile), only downloaded in a dev setup
+    nltk.data.find('corpora/stopwords')
+except LookupError:
+    nltk.download('stopwords')
 st.sidebar.title("Indy News Search")
 
 
@@ -0,0 +1,324 @@
+import json
+import os
+import re
+from collections import Counter
+from functools import lru_cache, partial
+from typing import Any, Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import numpy as np
+import numpy.typing as npt
+from llama_index.core.utils import globals_helper
+from nltk.stem import PorterStemmer
+
+from api.vector_store import _dump_json, _write
+
+meta_file = "bm25.json"
+offsets_file = "bm25_offsets.npy"
+docs_file = "bm25_docs.npy"
+tfs_file = "bm25_tfs.npy"
+weights_file = "bm25_weights.npy"
+doc_lens_file = "bm25_doc_lens.npy"
+bm25_hashes_file = "bm25_hashes.npy"
+# all the files of a bm25 index
+bm25_files = [
+    meta_file,
+    offsets_file,
+    docs_file,
+    tfs_file,
+    weights_file,
+    doc_lens_file,
+    bm25_hashes_file,
+]
+
+_word = re.compile(r"\w+")
+_stemmer = PorterStemmer()
+
+
+@lru_cache(maxsize=1)
+def _stopwords() -> FrozenSet[str]:
+    return frozenset(globals_helper.stopwords)
+
+
+@lru_cache(maxsize=100_000)
+def _stem(word: str) -> str:
+    return _stemmer.stem(word)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased words without the (english) stopwords, stemmed (like llama_index's BM25)."""
+    stopwords = _stopwords()
+    return [
+        _stem(word) for word in _word.findall(text.lower()) if word not in stopwords
+    ]
+
+
+class BM25Index:
+    """
+    Okapi BM25 (scored like rank_bm25's BM25Okapi) over inverted lists, persisted as:
+    - bm25.json: the terms (by term id) and the BM25 params
+    - bm25_offsets.npy: where the postings of each term id start (and the last one ends)
+    - bm25_docs.npy + bm25_tfs.npy: document and term frequency of each posting,
+      sorted by term and then document
+    - bm25_weights.npy: BM25 weight of each posting, with the idf and document length
+      normalization worked in, so a query only sums the weights of its postings
+    - bm25_doc_lens.npy + bm25_hashes.npy: token count and content hash per document
+    Documents are numbered by their position in the data (the json_doc_id).
+    The arrays are memory mapped read-only, adding or dropping documents gives a new index.
+    """
+
+    def __init__(
+        self,
+        terms: List[str],
+        offsets: npt.NDArray[np.int64],
+        docs: npt.NDArray[np.int32],
+        tfs: npt.NDArray[np.int32],
+        doc_lens: npt.NDArray[np.int32],
+        hashes: npt.NDArray[np.bytes_],
+        weights: Optional[npt.NDArray[np.float32]] = None,
+        params: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self.terms = terms
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_lens = doc_lens
+        self.hashes = hashes
+        self.params = params or {"k1": 1.5, "b": 0.75, "epsilon": 0.25}
+        self._term_ids = {term: i for i, term in enumerate(terms)}
+        self.weights = self._weigh() if weights is None else weights
+
+    def __len__(self) -> int:
+        return len(self.doc_lens)
+
+    @classmethod
+    def build(cls, texts: Sequence[str], hashes: npt.NDArray[np.bytes_]) -> "BM25Index":
+        empty = cls(
+            [],
+            np.zeros(1, dtype=np.int64),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype="S32"),
+        )
+        return empty.add(texts, hashes)
+
+    @classmethod
+    def exists(cls, persist_dir: str) -> bool:
+        return os.path.exists(os.path.join(persist_dir, meta_file))
+
+    @classmethod
+    def load(cls, persist_dir: str) -> "BM25Index":
+        with open(os.path.join(persist_dir, meta_file), encoding="utf-8") as f:
+            meta = json.load(f)
+
+        def load_array(file: str) -> npt.NDArray[Any]:
+            return np.load(os.path.join(persist_dir, file), mmap_mode="r")
+
+        return cls(
+            meta["terms"],
+            load_array(offsets_file),
+            load_array(docs_file),
+            load_array(tfs_file),
+            load_array(doc_lens_file),
+            load_array(bm25_hashes_file),
+            load_array(weights_file),
+            meta["params"],
+        )
+
+    def persist(self, persist_dir: str) -> None:
+        """Written like the vector store (see MmapVectorStore.persist)."""
+        os.makedirs(persist_dir, exist_ok=True)
+        arrays = {
+            offsets_file: self.offsets,
+            docs_file: self.docs,
+            tfs_file: self.tfs,
+            weights_file: self.weights,
+            doc_lens_file: self.doc_lens,
+            bm25_hashes_file: self.hashes,
+        }
+        for file, array in arrays.items():
+            _write(persist_dir, file, partial(np.save, arr=array))
+        meta = {"terms": self.terms, "params": self.params}
+        _write(persist_dir, meta_file, lambda path: _dump_json(path, meta))
+
+    def _posting_terms(self) -> npt.NDArray[np.int32]:
+        return np.repeat(
+            np.arange(len(self.terms), dtype=np.int32), np.diff(self.offsets)
+        )
+
+    def _weigh(self) -> npt.NDArray[np.float32]:
+        k1, b, epsilon = self.params["k1"], self.params["b"], self.params["epsilon"]
+        df = np.diff(self.offsets)
+        idf = np.log(len(self) - df + 0.5) - np.log(df + 0.5)
+        # like rank_bm25: terms in more than half of the documents get a small
+        # positive idf, relative to the average idf of the terms in use
+        used = df > 0
+        if used.any():
+            idf[used & (idf < 0)] = epsilon * idf[used].mean()
+        avgdl = self.doc_lens.mean() if len(self) and self.doc_lens.sum() else 1.0
+        norm = k1 * (1 - b + b * self.doc_lens / avgdl)
+        tfs = self.tfs.astype(np.float32)
+        weights = idf[self._posting_terms()] * tfs * (k1 + 1) / (tfs + norm[self.docs])
+        return weights.astype(np.float32)
+
+    @classmethod
+    def _from_postings(
+        cls,
+        terms: List[str],
+        posting_terms: npt.NDArray[np.int32],
+        docs: npt.NDArray[np.integer[Any]],
+        tfs: npt.NDArray[np.int32],
+        doc_lens: npt.NDArray[np.int32],
+        hashes: npt.NDArray[np.bytes_],
+        params: Dict[str, float],
+    ) -> "BM25Index":
+        order = np.lexsort((docs, posting_terms))
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(posting_terms, minlength=len(terms)), out=offsets[1:])
+        return cls(
+            terms,
+            offsets,
+            docs[order].astype(np.int32),
+            tfs[order].astype(np.int32),
+            doc_lens,
+            hashes,
+            params=params,
+        )
+
+    def add(self, texts: Sequence[str], hashes: npt.NDArray[np.bytes_]) -> "BM25Index":
+        """
+        A new index with the documents added (numbered after the current ones).
+        Only the new documents are tokenized, the weights of all postings are
+        updated (as the idf changes). The index itself is left alone, as it may be
+        in use by queries.
+        """
+        term_ids = dict(self._term_ids)
+        all_terms = list(self.terms)
+        terms, docs, tfs = [], [], []
+        doc_lens = []
+        for i, text in enumerate(texts, start=len(self)):
+            tokens = tokenize(text)
+            doc_lens.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_id = term_ids.get(term)
+                if term_id is None:
+                    term_id = term_ids[term] = len(all_terms)
+                    all_terms.append(term)
+                terms.append(term_id)
+                docs.append(i)
+                tfs.append(tf)
+        return self._from_postings(
+            all_terms,
+            np.concatenate([self._posting_terms(), np.array(terms, dtype=np.int32)]),
+            np.concatenate([self.docs, np.array(docs, dtype=np.int32)]),
+            np.concatenate([self.tfs, np.array(tfs, dtype=np.int32)]),
+            np.concatenate([self.doc_lens, np.array(doc_lens, dtype=np.int32)]),
+            np.concatenate([self.hashes, np.asarray(hashes, dtype="S32")]),
+            self.params,
+        )
+
+    def select(self, positions: Sequence[int]) -> "BM25Index":
+        """
+        A new index with only the documents at these positions, in that order
+        (so renumbered), without tokenizing anything again.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        renumbered = np.full(len(self), -1, dtype=np.int64)
+        renumbered[positions] = np.arange(len(positions))
+        keep = renumbered[self.docs] >= 0
+        return self._from_postings(
+            list(self.terms),
+            self._posting_terms()[keep],
+            renumbered[self.docs[keep]],
+            self.tfs[keep],
+            np.asarray(self.doc_lens[positions], dtype=np.int32),
+            np.asarray(self.hashes[positions], dtype="S32"),
+            self.params,
+        )
+
+    def search(
+        self,
+        queries: Sequence[str],
+        k: int,
+        allowed: Optional[npt.NDArray[np.bool_]] = None,
+    ) -> List[Tuple[npt.NDArray[np.float32], npt.NDArray[np.int32]]]:
+        """
+        The top k documents for each query, as (scores, documents) best first.
+        Only documents matching a query term are returned, and when allowed (a mask
+        over the documents) is given only those, filtered before scoring.
+        The postings of all queries are scored together, in one vectorized pass.
+        """
+        postings, query_ids = [], []
+        for i, query in enumerate(queries):
+            for term in tokenize(query):
+                term_id = self._term_ids.get(term)
+                if term_id is None:
+                    continue
+                start, end = self.offsets[term_id], self.offsets[term_id + 1]
+                postings.append(np.arange(start, end))
+                query_ids.append(np.full(end - start, i, dtype=np.int64))
+        if not postings:
+            return [(np.empty(0, np.float32), np.empty(0, np.int32)) for _ in queries]
+        selected = np.concatenate(postings)
+        docs = self.docs[selected]
+        posting_queries = np.concatenate(query_ids)
+        if allowed is not None:
+            keep = allowed[docs]
+            selected, docs = selected[keep], docs[keep]
+            posting_queries = posting_queries[keep]
+        # (query, document) pairs, summing the weights of their postings
+        keys = posting_queries * len(self) + docs
+        pairs, inverse = np.unique(keys, return_inverse=True)
+        scores = np.bincount(inverse, weights=self.weights[selected])
+        bounds = (pairs // len(self)).searchsorted(np.arange(len(queries) + 1))
+        results = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            query_scores = scores[start:end]
+            top = np.arange(len(query_scores))
+            if len(top) > k:
+                top = np.argpartition(-query_scores, k - 1)[:k]
+            top = top[np.argsort(-query_scores[top], kind="stable")]
+            results.append(
+                (
+                    query_scores[top].astype(np.float32),
+                    (pairs[start:end][top] % len(self)).astype(np.int32),
+                )
+            )
+        return results
+
+
+def sync_index(
+    bm25_index: Optional[BM25Index],
+    texts: Sequence[str],
+    hashes: npt.NDArray[np.bytes_],
+) -> Tuple[BM25Index, Dict[str, int]]:
+    """
+    Bring a BM25 index in line with the texts, by content hash: postings of
+    unchanged texts are kept, only added or changed texts are tokenized.
+    Returns the new (in memory) index and the counts of what changed.
+    """
+    if bm25_index is not None and np.array_equal(bm25_index.hashes, hashes):
+        return bm25_index, {"unchanged": len(hashes), "tokenized": 0, "dropped": 0}
+    positions: Dict[bytes, int] = {}
+    if bm25_index is not None:
+        positions = {h: i for i, h in enumerate(bm25_index.hashes.tolist())}
+    new_hashes = hashes.tolist()
+    kept = [i for i, h in enumerate(new_hashes) if h in positions]
+    added = [i for i, h in enumerate(new_hashes) if h not in positions]
+    if bm25_index is None:
+        index = BM25Index.build([texts[i] for i in added], hashes[added])
+    else:
+        index = bm25_index.select([positions[new_hashes[i]] for i in kept]).add(
+            [texts[i] for i in added], hashes[added]
+        )
+    # the kept texts come first, put them all in the given order
+    order = kept + added
+    if order != sorted(order):
+        index = index.select(np.argsort(order))
+    previous = len(bm25_index) if bm25_index is not None else 0
+    stats = {
+        "unchanged": len(kept),
+        "tokenized": len(added),
+        "dropped": previous - len(kept),
+    }
+    return index, stats
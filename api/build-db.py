@@ -0,0 +1,86 @@
+#!.venv/bin/python
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from api.bm25_index import BM25Index
+from api.embeddings import get_embed_model
+from api.engine import _get_documents
+from api.pipeline import (
+    build_data,
+    document_hashes,
+    sync_bm25_index,
+    sync_vector_store,
+    write_data,
+)
+from api.store import combined_file, csv_file, dimensions, mbfc_file, persist_dir
+from api.vector_store import MmapVectorStore, convert_legacy_store, has_legacy_store
+
+parser = argparse.ArgumentParser(
+    prog="build-db.py",
+    description="(Re)build combined.json and the vector db, embedding only the media that were added or changed.",
+)
+parser.add_argument(
+    "--db",
+    help="Directory containing the vector db",
+    default=persist_dir,
+)
+parser.add_argument("--csv", help="Media csv", default=csv_file)
+parser.add_argument("--mbfc", help="Media Bias/Fact Check json", default=mbfc_file)
+parser.add_argument("--out", help="Combined json to write", default=combined_file)
+parser.add_argument(
+    "--dry-run",
+    help="Only report what would change, don't embed or write anything",
+    action="store_true",
+)
+
+
+def main() -> None:
+    args = parser.parse_args()
+    start = time.perf_counter()
+    embed_model = get_embed_model(dimensions)
+
+    store = None
+    if MmapVectorStore.exists(args.db):
+        store = MmapVectorStore.load(args.db)
+    elif has_legacy_store(args.db):
+        store = convert_legacy_store(args.db)
+    if store is not None and store.hashes is None and os.path.exists(args.out):
+        # built before hashes were kept, from the combined json that is still there
+        with open(args.out, encoding="utf-8") as f:
+            previous = _get_documents(json.load(f))
+        store.hashes = document_hashes(previous, embed_model, dimensions)[store.doc_ids]
+
+    data = build_data(args.csv, args.mbfc)
+    documents = _get_documents(data)
+    hashes = document_hashes(documents, embed_model, dimensions)
+    known = (
+        set(store.hashes.tolist())
+        if store is not None and store.hashes is not None
+        else set()
+    )
+    to_embed = sum(1 for h in hashes.tolist() if h not in known)
+    print(f"{len(documents)} media, {to_embed} to embed")
+    if args.dry_run:
+        return
+
+    store, stats = sync_vector_store(store, documents, hashes, embed_model)
+    bm25_index = BM25Index.load(args.db) if BM25Index.exists(args.db) else None
+    bm25_index, bm25_stats = sync_bm25_index(bm25_index, documents, hashes)
+    # the db first: combined.json is only replaced when its vectors are in place
+    store.persist(args.db)
+    bm25_index.persist(args.db)
+    write_data(data, args.out)
+    print(
+        f"db written to {args.db} in {time.perf_counter() - start:.1f}s:"
+        f" {stats['unchanged']} unchanged, {stats['embedded']} embedded,"
+        f" {stats['dropped']} dropped, {bm25_stats['tokenized']} tokenized for bm25"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!.venv/bin/python
+import argparse
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from api.vector_store import MmapVectorStore, build_ann_index
+
+parser = argparse.ArgumentParser(prog="build-index.py")
+parser.add_argument(
+    "--db",
+    help="Directory containing the vector db",
+    default=os.environ.get("DB_DIR", "./db"),
+)
+parser.add_argument(
+    "--factory",
+    help='Faiss index factory string. Eg. "HNSW32", "IVF256,Flat", "IVF256,PQ64", or "none" to remove the ANN index',
+    default="HNSW32",
+)
+parser.add_argument(
+    "--dimensions",
+    help="Truncate the embeddings to this many dimensions",
+    type=int,
+    default=None,
+)
+parser.add_argument(
+    "--k", help="Number of results to measure recall@k on", type=int, default=10
+)
+parser.add_argument(
+    "--nprobe", help="IVF lists to probe when evaluating", type=int, default=None
+)
+parser.add_argument(
+    "--ef-search", help="HNSW search depth when evaluating", type=int, default=None
+)
+parser.add_argument(
+    "--queries",
+    help="Number of (noisy) document vectors to evaluate with",
+    type=int,
+    default=100,
+)
+parser.add_argument(
+    "--dry-run", help="Only evaluate, don't persist the index", action="store_true"
+)
+
+
+def _evaluate(
+    exact: MmapVectorStore, ann: MmapVectorStore, args: argparse.Namespace
+) -> None:
+    rng = np.random.default_rng(0)
+    rows = rng.choice(
+        len(exact.doc_ids), size=min(args.queries, len(exact.doc_ids)), replace=False
+    )
+    queries = np.array(exact.vectors[rows], dtype=np.float32)
+    queries += rng.normal(scale=0.01, size=queries.shape).astype(np.float32)
+    faiss.normalize_L2(queries)
+
+    timings = {}
+    results = {}
+    for name, store in [("exact", exact), ("ann", ann)]:
+        start = time.perf_counter()
+        results[name] = [
+            store.search(
+                query[np.newaxis, :],
+                args.k,
+                nprobe=args.nprobe,
+                ef_search=args.ef_search,
+            )[1][0]
+            for query in queries
+        ]
+        timings[name] = (time.perf_counter() - start) / len(queries) * 1000
+    recall = np.mean(
+        [
+            len(set(a) & set(e)) / len(e)
+            for a, e in zip(results["ann"], results["exact"])
+        ]
+    )
+    print(f"recall@{args.k}: {recall:.3f}")
+    print(
+        f"latency per query: exact {timings['exact']:.3f} ms, ann {timings['ann']:.3f} ms"
+    )
+    size = (
+        faiss.serialize_index(ann.ann_index).nbytes if ann.ann_index is not None else 0
+    )
+    print(f"size: vectors {exact.vectors.nbytes} bytes, ann index {size} bytes")
+
+
+def main() -> None:
+    args = parser.parse_args()
+
+    print(f"loading vectors from {args.db}")
+    store = MmapVectorStore.load(args.db)
+    exact = MmapVectorStore(store.vectors, store.doc_ids, hashes=store.hashes)
+    if args.factory == "none":
+        ann = exact
+    else:
+        print(
+            f"building {args.factory} index with {args.dimensions or store.dimensions} dimensions"
+        )
+        ann_index, ann_meta = build_ann_index(
+            store.vectors, args.factory, args.dimensions
+        )
+        ann = MmapVectorStore(
+            store.vectors, store.doc_ids, ann_index, ann_meta, store.hashes
+        )
+
+    _evaluate(exact, ann, args)
+
+    if not args.dry_run:
+        ann.persist(args.db)
+        print(f"index written to {args.db}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Any, Callable, Dict, List, Optional
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from lib.text import normalize_query
+
+# "openai" (default) or "local", see embed_providers below
+embed_provider = os.environ.get("EMBED_PROVIDER", "openai")
+embed_cache_file = os.environ.get("EMBED_CACHE_FILE", "./cache/embeddings.sqlite")
+embed_cache_size = int(os.environ.get("EMBED_CACHE_SIZE", "10000"))
+
+
+class HashEmbedding(BaseEmbedding):
+    """
+    Deterministic local embedding: word uni- and bigrams are hashed into signed
+    buckets and the result is L2 normalized.
+    Needs no network, so it can run the whole /media path offline (tests, benchmarks).
+    """
+
+    embed_dim: int
+
+    def __init__(self, embed_dim: int, **kwargs: Any) -> None:
+        super().__init__(embed_dim=embed_dim, model_name=f"hash-{embed_dim}", **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.embed_dim
+        tokens = re.findall(r"\w+", normalize_query(text))
+        bigrams = [a + " " + b for a, b in zip(tokens, tokens[1:])]
+        for feature in tokens + bigrams:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            h = int.from_bytes(digest, "little")
+            vector[h % self.embed_dim] += 1.0 if h >> 63 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class EmbeddingCache:
+    """
+    Disk backed LRU cache for embeddings, keyed by (model, dimensions, normalized text).
+    Vectors are stored as float32 blobs in sqlite, so they survive restarts
+    and are shared by all workers on the same host.
+    """
+
+    def __init__(self, path: str, maxsize: int = 10000) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings"
+            " (key TEXT PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)"
+        )
+
+    @staticmethod
+    def key(model: str, dimensions: int, text: str) -> str:
+        return f"{model}:{dimensions}:{normalize_query(text)}"
+
+    def get(self, key: str) -> Optional[List[float]]:
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        """Look up many keys at once (one query), None for the ones not cached."""
+        found: Dict[str, bytes] = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            # sqlite limits the number of query params
+            for start in range(0, len(unique), 500):
+                chunk = unique[start : start + 500]
+                params = ",".join("?" * len(chunk))
+                found.update(
+                    self._conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({params})",
+                        chunk,
+                    ).fetchall()
+                )
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        vectors: List[Optional[List[float]]] = []
+        for key in keys:
+            if key not in found:
+                vectors.append(None)
+                continue
+            vector = array("f")
+            vector.frombytes(found[key])
+            vectors.append(vector.tolist())
+        return vectors
+
+    def set(self, key: str, vector: List[float]) -> None:
+        self.set_many({key: vector})
+
+    def set_many(self, vectors: Dict[str, List[float]]) -> None:
+        """Store many vectors at once (one transaction), evicting the LRU ones."""
+        now = time.time()
+        rows = [
+            (key, array("f", vector).tobytes(), now) for key, vector in vectors.items()
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, used) VALUES (?, ?, ?)",
+                    rows,
+                )
+                (count,) = self._conn.execute(
+                    "SELECT COUNT(*) FROM embeddings"
+                ).fetchone()
+                if count > self.maxsize:
+                    # evict the least recently used entries
+                    self._conn.execute(
+                        "DELETE FROM embeddings WHERE key IN"
+                        " (SELECT key FROM embeddings ORDER BY used LIMIT ?)",
+                        (count - self.maxsize,),
+                    )
+                    self.evictions += count - self.maxsize
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model and serves query embeddings from an EmbeddingCache.
+    Text (document) embeddings are only computed at index build time, so those
+    go straight to the wrapped model.
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+    _dimensions: int = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        cache: EmbeddingCache,
+        dimensions: int,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._cache = cache
+        self._dimensions = dimensions
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def _key(self, query: str) -> str:
+        return EmbeddingCache.key(self.model_name, self._dimensions, query)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        key = self._key(query)
+        vector = self._cache.get(key)
+        if vector is None:
+            vector = self._embed_model.get_query_embedding(query)
+            self._cache.set(key, vector)
+        return vector
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        # sqlite is blocking (and syncs to disk), keep it off the event loop
+        key = self._key(query)
+        vector = await asyncio.to_thread(self._cache.get, key)
+        if vector is None:
+            vector = await self._embed_model.aget_query_embedding(query)
+            await asyncio.to_thread(self._cache.set, key, vector)
+        return vector
+
+    async def aget_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        """
+        Embed many queries at once: cached ones are looked up, the others are sent
+        to the wrapped model in one batch call. (The providers embed queries and
+        texts the same way, so the batched text embedding call is used for that.)
+        The cache is read and written in one go each, in a worker thread.
+        """
+        keys = [self._key(query) for query in queries]
+        vectors = await asyncio.to_thread(self._cache.get_many, keys)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            embedded = await self._embed_model.aget_text_embedding_batch(
+                [queries[i] for i in missing]
+            )
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+            await asyncio.to_thread(
+                self._cache.set_many, {keys[i]: vectors[i] for i in missing}
+            )
+        return vectors
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed_model.get_text_embedding(text)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return await self._embed_model.aget_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_model.get_text_embedding_batch(texts)
+
+
+def _openai_embedding(dimensions: int) -> BaseEmbedding:
+    # imported here, it pulls in the openai client which the local provider doesn't need
+    # pylint: disable-next=import-outside-toplevel
+    from llama_index.embeddings.openai import OpenAIEmbedding
+
+    return OpenAIEmbedding(model_name="text-embedding-3-large", dimensions=dimensions)
+
+
+# Embedding providers by name, each takes the number of dimensions.
+# NB: the index in ./db must be built with the same provider that is used for querying.
+embed_providers: Dict[str, Callable[[int], BaseEmbedding]] = {
+    "openai": _openai_embedding,
+    "local": HashEmbedding,
+}
+
+
+def get_embed_model(dimensions: int) -> CachedEmbedding:
+    embed_model = embed_providers[embed_provider](dimensions)
+    cache = EmbeddingCache(embed_cache_file, embed_cache_size)
+    return CachedEmbedding(embed_model, cache, dimensions)
@@ -0,0 +1,259 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import Document, NodeWithScore
+
+from api.bm25_index import BM25Index, bm25_files
+from api.embeddings import get_embed_model
+from api.pipeline import (
+    build_data,
+    document_hashes,
+    sync_bm25_index,
+    sync_vector_store,
+    write_data,
+)
+from api.retriever import (
+    BM25IndexRetriever,
+    HybridRetriever,
+    VectorRetriever,
+    fusions,
+)
+from api.store import (
+    FilterKey,
+    Media,
+    SnapshotError,
+    combined_file,
+    csv_file,
+    dimensions,
+    filter_fields,
+    filter_value,
+    fusion_mode,
+    fusion_weights,
+    index_ef_search,
+    index_nprobe,
+    mbfc_file,
+    persist_dir,
+)
+from api.vector_store import (
+    MmapVectorStore,
+    convert_legacy_store,
+    db_files,
+    has_legacy_store,
+)
+from lib.batcher import MicroBatcher
+from lib.json_response import encode_json
+
+logger = logging.getLogger(__name__)
+
+
+def _get_data() -> Tuple[List[Dict[str, str]], bytes]:
+    """Returns the records, and the raw json they were read from."""
+    if not os.path.exists(combined_file):
+        # combine the data (see api/build-db.py to rebuild it)
+        write_data(build_data(csv_file, mbfc_file), combined_file)
+    with open(combined_file, "rb") as f:
+        raw = f.read()
+    return json.loads(raw), raw
+
+
+def snapshot_signature() -> Tuple[int, ...]:
+    """Modification times of the snapshot files, to cheaply notice a new snapshot."""
+    files = [combined_file] + [
+        os.path.join(persist_dir, file) for file in db_files + bm25_files
+    ]
+    return tuple(os.stat(f).st_mtime_ns if os.path.exists(f) else 0 for f in files)
+
+
+def _get_documents(data: List[Dict[str, str]]) -> List[Document]:
+    """
+    Let's create custom documents from json to avoid cruft, to get more reliable scoring during retrieval.
+    We keep our own index to later map back to the original json dicts corresponding to the matching documents.
+    We are only interested in the following fields, so we just concat them into a single string:
+    - Name
+    - About
+    - Topics
+    """
+    documents = []
+    # iterate over the list of data and keep track of the index
+    for i, item in enumerate(data):
+        # create a document with the index as id
+        document = Document(
+            id_=str(i),
+            metadata={"json_doc_id": i},
+            text=item["Name"] + "\n" + item["About"] + "\n" + item["Topics"],
+        )
+        # add the document to the list
+        documents.append(document)
+    return documents
+
+
+def _get_index(
+    documents: List[Document], embed_model: BaseEmbedding
+) -> MmapVectorStore:
+    exists = MmapVectorStore.exists(persist_dir)
+    logger.info("DB exists: %s", exists)
+
+    if not exists:
+        if has_legacy_store(persist_dir):
+            logger.info("Converting legacy DB")
+            vector_store = convert_legacy_store(persist_dir)
+        else:
+            hashes = document_hashes(documents, embed_model, dimensions)
+            vector_store, _ = sync_vector_store(None, documents, hashes, embed_model)
+        vector_store.persist(persist_dir)
+    # (re)load from disk, so we get the memory mapped vectors
+    return MmapVectorStore.load(persist_dir)
+
+
+def _get_bm25_index(
+    documents: List[Document], hashes: npt.NDArray[np.bytes_]
+) -> BM25Index:
+    if not BM25Index.exists(persist_dir):
+        # e.g. a db built before there was a bm25 index
+        bm25_index, _ = sync_bm25_index(None, documents, hashes)
+        bm25_index.persist(persist_dir)
+        return BM25Index.load(persist_dir)
+    bm25_index = BM25Index.load(persist_dir)
+    if not np.array_equal(bm25_index.hashes, hashes):
+        # only tokenize what changed, but leave the db to api/build-db.py
+        logger.warning("BM25 index is out of date, rebuild it with api/build-db.py")
+        bm25_index, _ = sync_bm25_index(bm25_index, documents, hashes)
+    return bm25_index
+
+
+def _get_bitmaps(
+    data: List[Dict[str, str]],
+) -> Dict[Tuple[str, str], npt.NDArray[np.uint8]]:
+    """
+    Packed bitmaps (bit i is json_doc_id i) of the media per filter name and value,
+    "youtube" being "true" for the media with a Youtube channel.
+    """
+    doc_ids: Dict[Tuple[str, str], List[int]] = {}
+    for i, item in enumerate(data):
+        for name, field in filter_fields.items():
+            if item.get(field) is not None:
+                doc_ids.setdefault((name, filter_value(item[field])), []).append(i)
+        has_youtube = item.get("Youtube", "n/a") != "n/a"
+        doc_ids.setdefault(("youtube", str(has_youtube).lower()), []).append(i)
+    bitmaps = {}
+    for key, ids in doc_ids.items():
+        mask = np.zeros(len(data), dtype=bool)
+        mask[ids] = True
+        bitmaps[key] = np.packbits(mask, bitorder="little")
+    return bitmaps
+
+
+class RetrievalEngine:
+    """
+    Process-wide retrieval state for one snapshot (combined.json + ./db), loaded once
+    and shared by all queries:
+    - the media records from combined.json, their documents, and their json (as
+      the Media response model validates and serializes them)
+    - the vector store and the embedding model
+    - the BM25 index (tokenized when the db is built)
+    - a bitmap of the media per filter value (see MediaFilter)
+    The top_k and filter are passed per query, so no state is rebuilt on a cache miss.
+    The version identifies the snapshot, results cached for it are keyed by it.
+    """
+
+    def __init__(self) -> None:
+        # taken before reading, so changes made while loading are noticed later
+        self.signature = snapshot_signature()
+        self.data, raw = _get_data()
+        # validated and encoded once here, instead of on every response
+        self.encoded = [
+            encode_json(Media.model_validate(item).model_dump(mode="json"))
+            for item in self.data
+        ]
+        self.documents = _get_documents(self.data)
+        self.embed_model = get_embed_model(dimensions)
+        self.vector_store = _get_index(self.documents, self.embed_model)
+        self.hashes = document_hashes(self.documents, self.embed_model, dimensions)
+        self._verify()
+        digest = hashlib.sha256(raw)
+        if self.vector_store.hashes is not None:
+            digest.update(self.vector_store.hashes.tobytes())
+        else:
+            digest.update(np.ascontiguousarray(self.vector_store.vectors).tobytes())
+        self.version = digest.hexdigest()[:12]
+        self.bm25_index = _get_bm25_index(self.documents, self.hashes)
+        self.bitmaps = _get_bitmaps(self.data)
+        # concurrent retrievals (e.g. from a batch request) share one embedding call
+        # and one vector search
+        self.retrieve = MicroBatcher(self._retrieve_batch)
+
+    def _verify(self) -> None:
+        doc_ids = self.vector_store.doc_ids
+        if len(doc_ids) != len(self.documents) or (
+            len(doc_ids) > 0 and int(doc_ids.max()) >= len(self.documents)
+        ):
+            raise SnapshotError(
+                f"the index has {len(doc_ids)} documents, the data {len(self.documents)}"
+            )
+        if self.vector_store.hashes is not None:
+            if (self.vector_store.hashes != self.hashes[doc_ids]).any():
+                raise SnapshotError(
+                    "the index does not match the data, rebuild it with api/build-db.py"
+                )
+
+    def filter_mask(self, filter_key: FilterKey) -> Optional[npt.NDArray[np.bool_]]:
+        """
+        The media passing a filter as a mask over the json_doc_ids (None for no
+        filter): any of the values of a filter, and all of the filters.
+        """
+        if not filter_key:
+            return None
+        packed = np.full((len(self.data) + 7) // 8, 0xFF, dtype=np.uint8)
+        for name, values in filter_key:
+            any_of = np.zeros_like(packed)
+            for value in values:
+                bitmap = self.bitmaps.get((name, value))
+                if bitmap is not None:
+                    any_of |= bitmap
+            packed &= any_of
+        mask = np.unpackbits(packed, count=len(self.data), bitorder="little")
+        return mask.astype(bool)
+
+    def get_retriever(
+        self, top_k: int, allowed: Optional[npt.NDArray[np.bool_]] = None
+    ) -> HybridRetriever:
+        # fusion ranks the candidates properly, so there is no need to over-fetch,
+        # and filters restrict both searches, so neither is there for filters
+        vector_retriever = VectorRetriever(
+            self.vector_store,
+            self.embed_model,
+            self.documents,
+            top_k,
+            nprobe=index_nprobe,
+            ef_search=index_ef_search,
+            allowed=allowed,
+        )
+        return HybridRetriever(
+            vector_retriever,
+            BM25IndexRetriever(self.bm25_index, self.documents, top_k, allowed),
+            top_k=top_k,
+            fusion=fusions[fusion_mode],
+            weights=fusion_weights,
+        )
+
+    async def _retrieve_batch(
+        self, items: List[Tuple[str, int, FilterKey]]
+    ) -> List[List[NodeWithScore]]:
+        # items are (query, top_k, filter), and are retrieved together per top_k and
+        # filter
+        groups: Dict[Tuple[int, FilterKey], List[int]] = {}
+        for i, (_, top_k, filter_key) in enumerate(items):
+            groups.setdefault((top_k, filter_key), []).append(i)
+        results: List[List[NodeWithScore]] = [[] for _ in items]
+        for (top_k, filter_key), indexes in groups.items():
+            retriever = self.get_retriever(top_k, self.filter_mask(filter_key))
+            nodes = await retriever.aretrieve_batch([items[i][0] for i in indexes])
+            for i, ranked in zip(indexes, nodes):
+                results[i] = ranked
+        return results
@@ -0,0 +1,179 @@
+import heapq
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+from lib.json_response import encode_json
+
+Record = Dict[str, str]
+
+
+def _trigrams(text: str) -> List[str]:
+    return [text[i : i + 3] for i in range(len(text) - 2)]
+
+
+def _padded_trigrams(text: str) -> Set[str]:
+    # padding makes word starts/ends count, which helps short names and typos at the edges
+    return set(_trigrams("  " + " ".join(text.split()) + " "))
+
+
+class NameIndex:
+    """
+    In-memory index over the "name" field of a list of records:
+    - lowercased names are computed once
+    - a trigram index maps each trigram to the (ascending) ids of the names containing it
+    - a padded trigram index (plus trigram counts per name) for fuzzy lookups
+    - the json encoded records, so responses are assembled without encoding them
+    A substring lookup only verifies the names in the shortest posting list of the
+    query's trigrams, instead of scanning all names.
+    """
+
+    def __init__(self, records: List[Record]) -> None:
+        self.records = records
+        self.encoded = [encode_json(record) for record in records]
+        self.names = [record["name"].lower() for record in records]
+        postings: Dict[str, List[int]] = {}
+        for i, name in enumerate(self.names):
+            for trigram in set(_trigrams(name)):
+                postings.setdefault(trigram, []).append(i)
+        self.postings = {trigram: tuple(ids) for trigram, ids in postings.items()}
+        self.all_ids = tuple(range(len(records)))
+        fuzzy_postings: Dict[str, List[int]] = {}
+        self.trigram_counts: List[int] = []
+        for i, name in enumerate(self.names):
+            trigrams = _padded_trigrams(name)
+            self.trigram_counts.append(len(trigrams))
+            for trigram in trigrams:
+                fuzzy_postings.setdefault(trigram, []).append(i)
+        self.fuzzy_postings = {
+            trigram: tuple(ids) for trigram, ids in fuzzy_postings.items()
+        }
+
+    def _candidates(self, query: str) -> Tuple[int, ...]:
+        if len(query) < 3:
+            return self.all_ids
+        shortest = self.all_ids
+        for trigram in _trigrams(query):
+            ids = self.postings.get(trigram)
+            if ids is None:
+                return ()
+            if len(ids) < len(shortest):
+                shortest = ids
+        return shortest
+
+    def _search_ids(self, query: str, limit: int, offset: int) -> List[int]:
+        query = query.lower()
+        end = offset + limit
+        ids: List[int] = []
+        found = 0
+        for i in self._candidates(query):
+            if query in self.names[i]:
+                if found >= offset:
+                    ids.append(i)
+                found += 1
+                if found >= end:
+                    break
+        return ids
+
+    def search(self, query: str, limit: int = 5, offset: int = 0) -> List[Record]:
+        """
+        Find the records whose name contains the query (case insensitive),
+        in the original order of the records.
+        """
+        return [self.records[i] for i in self._search_ids(query, limit, offset)]
+
+    def search_json(self, query: str, limit: int = 5, offset: int = 0) -> List[bytes]:
+        """search, returning the json encoded records."""
+        return [self.encoded[i] for i in self._search_ids(query, limit, offset)]
+
+    def _fuzzy_ids(
+        self, query: str, limit: int, offset: int, min_score: float
+    ) -> List[Tuple[int, float]]:
+        trigrams = _padded_trigrams(query.lower())
+        shared: Dict[int, int] = {}
+        for trigram in trigrams:
+            for i in self.fuzzy_postings.get(trigram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        scores = {
+            i: count / (len(trigrams) + self.trigram_counts[i] - count)
+            for i, count in shared.items()
+        }
+        ranked = heapq.nlargest(
+            offset + limit,
+            (i for i, score in scores.items() if score >= min_score),
+            key=lambda i: (scores[i], -i),
+        )
+        return [(i, round(scores[i], 3)) for i in ranked[offset:]]
+
+    def fuzzy_search(
+        self, query: str, limit: int = 5, offset: int = 0, min_score: float = 0.2
+    ) -> List[Dict[str, Union[str, float]]]:
+        """
+        Find the records whose name is most similar to the query, ranked by
+        the jaccard similarity of their (padded) trigram sets.
+        The records are returned with that similarity as "score".
+        """
+        return [
+            {**self.records[i], "score": score}
+            for i, score in self._fuzzy_ids(query, limit, offset, min_score)
+        ]
+
+    def fuzzy_search_json(
+        self, query: str, limit: int = 5, offset: int = 0, min_score: float = 0.2
+    ) -> List[bytes]:
+        """fuzzy_search, returning the json encoded records (with their "score")."""
+        # the score goes in as the last key, like {**record, "score": score}
+        return [
+            self.encoded[i][:-1]
+            + (b',"score":' if self.records[i] else b'"score":')
+            + encode_json(score)
+            + b"}"
+            for i, score in self._fuzzy_ids(query, limit, offset, min_score)
+        ]
+
+
+class NameLookup:
+    """
+    Lazily loads a json snapshot into a NameIndex and reloads it when the
+    file's mtime changes. Records not passing the (optional) eligibility check
+    are left out at load time, so they cost nothing per request.
+    """
+
+    def __init__(
+        self, file: str, eligible: Optional[Callable[[Record], bool]] = None
+    ) -> None:
+        self.file = file
+        self.eligible = eligible
+        self._index: Optional[NameIndex] = None
+        self._mtime = 0
+        self._lock = threading.Lock()
+
+    def get(self) -> NameIndex:
+        mtime = os.stat(self.file).st_mtime_ns
+        if self._index is None or mtime != self._mtime:
+            with self._lock:
+                if self._index is None or mtime != self._mtime:
+                    with open(self.file, encoding="utf-8") as f:
+                        records = json.load(f)
+                    if self.eligible is not None:
+                        records = [r for r in records if self.eligible(r)]
+                    self._index = NameIndex(records)
+                    self._mtime = mtime
+        return self._index
+
+    def search(self, query: str, limit: int = 5, offset: int = 0) -> List[Record]:
+        return self.get().search(query, limit, offset)
+
+    def fuzzy_search(
+        self, query: str, limit: int = 5, offset: int = 0
+    ) -> List[Dict[str, Union[str, float]]]:
+        return self.get().fuzzy_search(query, limit, offset)
+
+    def search_json(self, query: str, limit: int = 5, offset: int = 0) -> List[bytes]:
+        return self.get().search_json(query, limit, offset)
+
+    def fuzzy_search_json(
+        self, query: str, limit: int = 5, offset: int = 0
+    ) -> List[bytes]:
+        return self.get().fuzzy_search_json(query, limit, offset)
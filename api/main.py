@@ -1,47 +1,298 @@
+import asyncio
+import json
+import logging
 import os
-from typing import Dict, List
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Literal, Optional, Tuple, Union
 
-from fastapi import Depends, FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 
-from api.store import Media, query_allsides, query_media, query_mediabiasfactcheck
-from api.tools.youtube import Video, search_youtube_channel
+from api.metrics import instrument
+from api.store import (
+    Media,
+    MediaFilter,
+    SnapshotError,
+    aget_engine,
+    engine_loaded,
+    get_engine,
+    load_engine,
+    query_allsides_json,
+    query_media,
+    query_media_batch,
+    query_media_json,
+    query_mediabiasfactcheck_json,
+    reload_engine_if_changed,
+    reload_interval,
+)
+from api.tools.youtube import Video, close_clients, search_youtube_channel
+from api.tools.youtube_catalog import (
+    Videos,
+    catalog_interval,
+    refresh_catalog,
+    video_catalog,
+)
+from lib import metrics, tracing
 from lib.auth import verify_apikey
+from lib.json_response import JSONFragmentsResponse
+from lib.text import normalize_query
+from lib.tracing import TracingMiddleware
+
+logger = logging.getLogger(__name__)
 
 api_token = os.environ["API_KEY"]
-app = FastAPI()
+# max number of queries in a batch request
+max_batch_size = int(os.environ.get("MAX_BATCH_SIZE", "32"))
+# /youtube only looks at media with a channel
+youtube_filter = MediaFilter(youtube=True)
+
+
+async def _watch_snapshot() -> None:
+    # loads a new snapshot off the request path, queries keep running on the old one
+    while True:
+        await asyncio.sleep(reload_interval)
+        try:
+            engine = await asyncio.to_thread(reload_engine_if_changed)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # e.g. a rebuild in progress, retried on the next check
+            logger.warning("Not reloading the snapshot: %s", e)
+            continue
+        if engine is not None:
+            logger.info("Loaded snapshot %s", engine.version)
+
+
+def _catalog_channels() -> List[str]:
+    # the channels of the current snapshot, none until the engine is warm
+    if not engine_loaded():
+        return []
+    return [item["Youtube"] for item in get_engine().data if item["Youtube"] != "n/a"]
+
+
+@asynccontextmanager
+async def lifespan(app_: FastAPI) -> AsyncIterator[None]:
+    # warm up the retrieval engine in the background, so we start serving (e.g. the
+    # lookups and /ready) right away, queries arriving early wait for it
+    app_.state.warm_up = asyncio.create_task(asyncio.to_thread(get_engine))
+    watcher = asyncio.create_task(_watch_snapshot()) if reload_interval > 0 else None
+    refresher = None
+    if catalog_interval > 0:
+        await asyncio.to_thread(video_catalog.load)
+        refresher = asyncio.create_task(
+            refresh_catalog(video_catalog, _catalog_channels)
+        )
+    yield
+    for task in [watcher, refresher]:
+        if task is not None:
+            task.cancel()
+    await close_clients()
+
+
+app = FastAPI(lifespan=lifespan)
+if metrics.enabled:
+    instrument(app)
+if tracing.enabled:
+    app.add_middleware(TracingMiddleware)
+
+
+class MediaBatch(BaseModel):
+    """Batch of /media queries, sharing the paging params and filters"""
+
+    queries: List[str] = Field(max_length=max_batch_size)
+    limit: int = Field(5, ge=1)
+    offset: int = Field(0, ge=0)
+    filters: MediaFilter = MediaFilter()
+
 
+class YoutubeBatch(BaseModel):
+    """Batch of /youtube queries, sharing the other params"""
 
-@app.get("/allsides", response_model=List[Dict[str, str]])
+    queries: List[str] = Field(max_length=max_batch_size)
+    period_days: int = 1
+    max_channels: int = 8
+    max_videos_per_channel: int = 3
+
+
+# The lookups and /media return their records pre-encoded (see JSONFragmentsResponse),
+# the response_model only documents them.
+@app.get(
+    "/allsides",
+    response_model=List[Dict[str, Union[str, float]]],
+    response_class=JSONFragmentsResponse,
+)
 def search_allsides(
     name: str,
     limit: int = 5,
     offset: int = 0,
+    mode: Literal["substring", "fuzzy"] = "substring",
     _: None = Depends(verify_apikey),
-) -> List[Dict[str, str]]:
-    results = query_allsides(name, limit, offset)
-    return results[offset:]
+) -> JSONFragmentsResponse:
+    """
+    Search by (partial) name. The "fuzzy" mode is typo tolerant and
+    returns the best matches first, with their similarity as "score".
+    """
+    return JSONFragmentsResponse(query_allsides_json(name, limit, offset, mode))
 
 
-@app.get("/mediabiasfactcheck", response_model=List[Dict[str, str]])
+@app.get(
+    "/mediabiasfactcheck",
+    response_model=List[Dict[str, Union[str, float]]],
+    response_class=JSONFragmentsResponse,
+)
 def search_mediabiasfactcheck(
     name: str,
     limit: int = 5,
     offset: int = 0,
+    mode: Literal["substring", "fuzzy"] = "substring",
     _: None = Depends(verify_apikey),
-) -> List[Dict[str, str]]:
-    results = query_mediabiasfactcheck(name, limit, offset)
-    return results[offset:]
+) -> JSONFragmentsResponse:
+    """
+    Search by (partial) name. The "fuzzy" mode is typo tolerant and
+    returns the best matches first, with their similarity as "score".
+    """
+    return JSONFragmentsResponse(
+        query_mediabiasfactcheck_json(name, limit, offset, mode)
+    )
 
 
-@app.get("/media", response_model=List[Media])
+@app.get("/media", response_model=List[Media], response_class=JSONFragmentsResponse)
 async def search_media(
     query: str,
-    limit: int = 5,
-    offset: int = 0,
+    limit: int = Query(5, ge=1),
+    offset: int = Query(0, ge=0),
+    bias: Optional[List[str]] = Query(None),
+    factual: Optional[List[str]] = Query(None),
+    credibility: Optional[List[str]] = Query(None),
+    youtube: Optional[bool] = None,
     _: None = Depends(verify_apikey),
-) -> List[Media]:
-    results = await query_media(query, top_k=limit + offset)
-    return results[offset:]
+) -> JSONFragmentsResponse:
+    """
+    Search media by topic. The filters (repeat a param to accept any of its values,
+    e.g. bias=left-center&bias=center) are applied during retrieval, so a filtered
+    page is as full as an unfiltered one (as long as enough media match).
+    """
+    filters = MediaFilter(
+        bias=bias, factual=factual, credibility=credibility, youtube=youtube
+    )
+    return JSONFragmentsResponse(
+        await query_media_json(query, top_k=limit, offset=offset, filters=filters)
+    )
+
+
+@app.post("/media/batch", response_model=List[List[Media]])
+async def search_media_batch(
+    batch: MediaBatch,
+    _: None = Depends(verify_apikey),
+) -> List[List[Dict[str, str]]]:
+    """
+    Search many topics at once. Returns the results per query, in the same order.
+    """
+    return await query_media_batch(
+        batch.queries, top_k=batch.limit, offset=batch.offset, filters=batch.filters
+    )
+
+
+async def _channel_videos(
+    query: str,
+    media: List[Dict[str, str]],
+    period_days: int,
+    max_channels: int,
+    max_videos_per_channel: int,
+) -> AsyncIterator[Tuple[int, str, Videos]]:
+    """
+    Yields (media rank, channel url, videos) per channel with videos, in the order
+    the channels complete, until we have max_channels of them.
+    The media are expected to have a channel (see youtube_filter).
+    """
+
+    async def fetch(rank: int, channel_url: str) -> Tuple[int, str, Videos]:
+        # the catalog has the recent uploads of the channels, if enabled
+        videos = video_catalog.search(
+            channel_url, query, period_days, max_videos_per_channel
+        )
+        if videos is not None:
+            return rank, channel_url, videos
+        result = await search_youtube_channel(
+            channel_url, query, period_days, max_videos_per_channel
+        )
+        return rank, channel_url, result.videos
+
+    # query all candidate channels concurrently, and stop as soon as we have enough
+    pending = {
+        asyncio.create_task(fetch(rank, item["Youtube"]))
+        for rank, item in enumerate(media)
+    }
+    found = 0
+    try:
+        while pending and found < max_channels:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                rank, channel_url, videos = task.result()
+                if len(videos) > 0 and found < max_channels:
+                    found += 1
+                    yield rank, channel_url, videos
+    finally:
+        # also when the consumer stops early (e.g. a client disconnecting)
+        for task in pending:
+            task.cancel()
+
+
+async def _youtube_videos(
+    query: str,
+    media: List[Dict[str, str]],
+    period_days: int,
+    max_channels: int,
+    max_videos_per_channel: int,
+) -> Videos:
+    found: Dict[int, Videos] = {}
+    async for rank, _, videos in _channel_videos(
+        query, media, period_days, max_channels, max_videos_per_channel
+    ):
+        found[rank] = videos
+    # keep the media ranking order
+    ret = []
+    for rank in sorted(found):
+        ret.extend(found[rank])
+    logger.debug("Number of videos found: %d", len(ret))
+    return ret
+
+
+async def stream_youtube(
+    query: str,
+    period_days: int = 1,
+    max_channels: int = 8,
+    max_videos_per_channel: int = 3,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    The /youtube search as events, a "channel" event (with the media rank of the
+    channel and its videos) as soon as a channel is parsed, and a "summary" event
+    at the end.
+    """
+    start = time.perf_counter()
+    # twice the channels, as not all of them have recent videos on the query
+    media = await query_media(query, top_k=max_channels * 2, filters=youtube_filter)
+    channels, videos = 0, 0
+    async for rank, channel_url, channel_videos in _channel_videos(
+        query, media, period_days, max_channels, max_videos_per_channel
+    ):
+        channels += 1
+        videos += len(channel_videos)
+        yield {
+            "event": "channel",
+            "rank": rank,
+            "channel_url": channel_url,
+            "videos": channel_videos,
+        }
+    yield {
+        "event": "summary",
+        "channels": channels,
+        "video_count": videos,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+    }
 
 
 @app.get("/youtube", response_model=List[Video])
@@ -51,24 +302,102 @@ async def search_youtube(
     max_channels: int = 8,
     max_videos_per_channel: int = 3,
     _: None = Depends(verify_apikey),
-) -> List[Video]:
-    media = await query_media(query, top_k=max_channels * 2)
-    tmp = {}
-    for item in media:
-        if not "Youtube" in item or item["Youtube"] == "n/a":
-            continue
-        ret = search_youtube_channel(
-            item["Youtube"], query, period_days, max_videos_per_channel
+) -> Videos:
+    media = await query_media(query, top_k=max_channels * 2, filters=youtube_filter)
+    return await _youtube_videos(
+        query, media, period_days, max_channels, max_videos_per_channel
+    )
+
+
+@app.get("/youtube/stream")
+async def search_youtube_stream(
+    query: str,
+    period_days: int = 1,
+    max_channels: int = 8,
+    max_videos_per_channel: int = 3,
+    format: Literal["ndjson", "sse"] = "ndjson",  # pylint: disable=redefined-builtin
+    _: None = Depends(verify_apikey),
+) -> StreamingResponse:
+    """
+    Like /youtube, but streams the videos per channel as soon as they come in
+    (fastest channel first), as NDJSON lines or server-sent events:
+    - "channel" events with the channel's media "rank" (to restore the /youtube
+      order), its "channel_url" and "videos"
+    - a final "summary" event with the number of "channels" and the "video_count"
+    """
+
+    async def lines() -> AsyncIterator[str]:
+        async for event in stream_youtube(
+            query, period_days, max_channels, max_videos_per_channel
+        ):
+            data = json.dumps(jsonable_encoder(event))
+            if format == "sse":
+                yield f"event: {event['event']}\ndata: {data}\n\n"
+            else:
+                yield data + "\n"
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(lines(), media_type=media_type)
+
+
+@app.post("/youtube/batch", response_model=List[List[Video]])
+async def search_youtube_batch(
+    batch: YoutubeBatch,
+    _: None = Depends(verify_apikey),
+) -> List[Videos]:
+    """
+    Search videos for many topics at once. Returns the videos per query,
+    in the same order.
+    """
+    # queries that normalize the same are searched (and their channels fetched) once
+    queries = list(dict.fromkeys(normalize_query(query) for query in batch.queries))
+    media = await query_media_batch(
+        queries, top_k=batch.max_channels * 2, filters=youtube_filter
+    )
+    videos = await asyncio.gather(
+        *(
+            _youtube_videos(
+                query,
+                items,
+                batch.period_days,
+                batch.max_channels,
+                batch.max_videos_per_channel,
+            )
+            for query, items in zip(queries, media)
         )
-        if len(ret) > 0:
-            tmp[item["Name"]] = ret
-        if len(tmp.keys()) >= max_channels:
-            break
-    ret = []
-    for item in tmp.values():
-        ret.extend(item)
-    print("Number of videos found: " + str(len(ret)))
-    return ret
+    )
+    by_query = dict(zip(queries, videos))
+    return [by_query[normalize_query(query)] for query in batch.queries]
+
+
+@app.post("/admin/reload")
+async def reload_snapshot(
+    _: None = Depends(verify_apikey),
+) -> Dict[str, str]:
+    """
+    Load the data and index snapshot on disk, and swap it in.
+    Returns its version.
+    """
+    try:
+        engine = await asyncio.to_thread(load_engine)
+    except SnapshotError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    return {"version": engine.version}
+
+
+@app.get("/ready")
+async def ready(request: Request) -> Dict[str, str]:
+    """
+    Readiness probe: 503 until the retrieval engine is loaded, then its version.
+    """
+    if not request.app.state.warm_up.done():
+        raise HTTPException(status_code=503, detail="loading")
+    try:
+        # loaded by now, unless the warm up failed (e.g. halfway a rebuild): retry it
+        engine = await aget_engine()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        raise HTTPException(status_code=503, detail=str(e)) from e
+    return {"status": "ready", "version": engine.version}
 
 
 @app.get("/privacy")
@@ -0,0 +1,88 @@
+import time
+from typing import Awaitable, Callable, List
+
+from fastapi import Depends, FastAPI, Request, Response
+
+from api.store import engine_loaded, get_engine
+from lib.auth import verify_apikey
+from lib.cache import caches
+from lib.metrics import Sample, register_collector, render, request_duration
+
+cache_events = ["l1_hits", "l2_hits", "misses", "refreshes", "evictions"]
+
+
+def _collect_caches() -> List[Sample]:
+    stats = {name: snapshot() for name, snapshot in caches.items()}
+    return [
+        (
+            "cache_events_total",
+            "counter",
+            "Async cache lookups and evictions",
+            {
+                (name, event): s[event]
+                for name, s in stats.items()
+                for event in cache_events
+            },
+            ["cache", "event"],
+        ),
+        (
+            "cache_entries",
+            "gauge",
+            "Entries in the in-process cache tier",
+            {(name,): s["size"] for name, s in stats.items()},
+            ["cache"],
+        ),
+        (
+            "cache_in_flight",
+            "gauge",
+            "Calls in flight (shared by concurrent callers)",
+            {(name,): s["in_flight"] for name, s in stats.items()},
+            ["cache"],
+        ),
+    ]
+
+
+def _collect_embeddings() -> List[Sample]:
+    if not engine_loaded():
+        # don't make the scrape wait for the warm up
+        return []
+    stats = get_engine().embed_model.cache.stats()
+    return [
+        (
+            "embedding_cache_events_total",
+            "counter",
+            "Query embedding cache lookups and evictions",
+            {(event,): count for event, count in stats.items()},
+            ["event"],
+        )
+    ]
+
+
+def instrument(app: FastAPI) -> None:
+    """
+    Time all requests per endpoint, and serve the metrics (in the Prometheus
+    text format) on /metrics.
+    """
+    register_collector(_collect_caches)
+    register_collector(_collect_embeddings)
+
+    @app.middleware("http")
+    async def time_request(
+        request: Request, call_next: Callable[[Request], Awaitable[Response]]
+    ) -> Response:
+        start = time.perf_counter()
+        response = await call_next(request)
+        route = request.scope.get("route")
+        # only known routes, so unknown urls can't blow up the number of series
+        path = getattr(route, "path", "other")
+        request_duration.observe(
+            time.perf_counter() - start,
+            request.method,
+            path,
+            str(response.status_code),
+        )
+        return response
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics(_: None = Depends(verify_apikey)) -> Response:
+        return Response(render(), media_type="text/plain; version=0.0.4")
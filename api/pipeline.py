@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import Document
+
+from api.bm25_index import BM25Index, sync_index
+from api.vector_store import MmapVectorStore, build_ann_index, update_ann_index
+
+# MBFC fields merged into the media records, in record column order
+fact_columns = {
+    "bias": "Bias",
+    "profile": "Profile",
+    "factual": "Factual",
+    "credibility": "Credibility",
+}
+
+
+def _name_keys(names: pd.Series) -> pd.Series:
+    # casefolded, with punctuation and whitespace runs collapsed to a single space
+    return (
+        names.fillna("")
+        .str.normalize("NFKC")
+        .str.casefold()
+        .str.replace(r"[\W_]+", " ", regex=True)
+        .str.strip()
+    )
+
+
+def _domain_keys(urls: pd.Series) -> pd.Series:
+    # "https://www.example.com:443/news" -> "example.com"
+    return (
+        urls.fillna("")
+        .str.strip()
+        .str.lower()
+        .str.replace(r"^[a-z]+://", "", regex=True)
+        .str.replace(r"^www\.", "", regex=True)
+        .str.replace(r"[/:?#].*$", "", regex=True)
+    )
+
+
+def combine(media: pd.DataFrame, facts: List[Dict[str, str]]) -> pd.DataFrame:
+    """
+    Merge the MBFC facts into the media records, with two (vectorized) joins:
+    - on the normalized name
+    - on the website domain against the MBFC url, for records without a name match
+    Domains that occur more than once in MBFC (e.g. shared platforms) are not matched on.
+    """
+    facts_df = pd.DataFrame(facts, columns=["name", "url", *fact_columns])
+    by_name = (
+        facts_df.assign(key=_name_keys(facts_df["name"]))
+        .drop_duplicates("key", keep="last")
+        .set_index("key")
+    )
+    by_domain = facts_df.assign(key=_domain_keys(facts_df["url"]))
+    by_domain = (
+        by_domain[by_domain["key"] != ""]
+        .drop_duplicates("key", keep=False)
+        .set_index("key")
+    )
+    name_matches = by_name.reindex(_name_keys(media["Name"]))[list(fact_columns)]
+    domain_matches = by_domain.reindex(_domain_keys(media["Website"]))[
+        list(fact_columns)
+    ]
+    matches = name_matches.reset_index(drop=True).combine_first(
+        domain_matches.reset_index(drop=True)
+    )
+    matches.index = media.index
+    return pd.concat([media, matches.rename(columns=fact_columns)], axis=1)
+
+
+def build_data(csv_file: str, mbfc_file: str) -> List[Dict[str, str]]:
+    media = pd.read_csv(csv_file, na_filter=False)
+    with open(mbfc_file, encoding="utf-8") as f:
+        facts = json.load(f)
+    df = combine(media, facts)
+    missing = df.loc[df["Bias"].isna(), "Name"].tolist()
+    if missing:
+        print(f"Facts not found for {len(missing)} media: {', '.join(missing)}")
+    # NaN -> None, which pandas only does for object columns
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+
+def write_data(data: List[Dict[str, str]], file: str) -> None:
+    # write next to the destination and move it in place, so readers never see half a file
+    tmp_file = f"{file}.tmp.{os.getpid()}"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_file, file)
+
+
+def document_hashes(
+    documents: List[Document], embed_model: BaseEmbedding, dimensions: int
+) -> npt.NDArray[np.bytes_]:
+    """
+    Content hash per document. The embedding model is part of it,
+    so switching providers re-embeds everything.
+    """
+    prefix = f"{embed_model.model_name}:{dimensions}\n"
+    return np.array(
+        [
+            hashlib.sha256((prefix + document.text).encode("utf-8")).hexdigest()[:32]
+            for document in documents
+        ],
+        dtype="S32",
+    )
+
+
+def sync_vector_store(
+    vector_store: Optional[MmapVectorStore],
+    documents: List[Document],
+    hashes: npt.NDArray[np.bytes_],
+    embed_model: BaseEmbedding,
+) -> Tuple[MmapVectorStore, Dict[str, int]]:
+    """
+    Bring a vector store in line with the documents, by content hash:
+    vectors of unchanged documents are kept (and get their new doc ids),
+    added or changed documents are embedded (in batches), and the rest is dropped.
+    An IVF index is updated the same way, keeping its training until too much
+    changed (see update_ann_index). Otherwise the ANN index is rebuilt (and
+    retrained) with the same settings.
+    Returns the new (in memory) store and the counts of what changed.
+    """
+    rows: Dict[bytes, int] = {}
+    if vector_store is not None and vector_store.hashes is not None:
+        rows = {h: row for row, h in enumerate(vector_store.hashes.tolist())}
+    new_hashes = hashes.tolist()
+    kept = [i for i, h in enumerate(new_hashes) if h in rows]
+    embed = [i for i, h in enumerate(new_hashes) if h not in rows]
+    # no documents at all: an empty store, of the dimensions it had
+    embedded = np.empty(
+        (0, vector_store.dimensions if vector_store is not None else 0),
+        dtype=np.float32,
+    )
+    if embed:
+        embedded = np.array(
+            embed_model.get_text_embedding_batch(
+                [documents[i].text for i in embed], show_progress=True
+            ),
+            dtype=np.float32,
+        )
+    if not kept:
+        vectors = embedded
+    else:
+        vectors = np.empty((len(documents), vector_store.dimensions), dtype=np.float32)
+        vectors[kept] = vector_store.vectors[[rows[new_hashes[i]] for i in kept]]
+        if embed:
+            vectors[embed] = embedded
+    doc_ids = np.array(
+        [document.metadata["json_doc_id"] for document in documents], dtype=np.int32
+    )
+
+    ann_index, ann_meta = None, None
+    if vector_store is not None and vector_store.ann_index is not None:
+        # the new row of each old one, new rows of documents sharing a vector
+        # (with the same text) are added like the embedded ones
+        moved = np.full(len(vector_store.doc_ids), -1, dtype=np.int64)
+        added = list(embed)
+        for i in kept:
+            row = rows[new_hashes[i]]
+            if moved[row] < 0:
+                moved[row] = i
+            else:
+                added.append(i)
+        updated = update_ann_index(
+            vector_store.ann_index,
+            vector_store.ann_meta,
+            vectors,
+            moved,
+            np.array(sorted(added), dtype=np.int64),
+        )
+        if updated is None:
+            updated = build_ann_index(
+                vectors,
+                vector_store.ann_meta["factory"],
+                vector_store.ann_meta.get("dimensions"),
+            )
+        ann_index, ann_meta = updated
+    previous = len(vector_store.doc_ids) if vector_store is not None else 0
+    stats = {
+        "unchanged": len(kept),
+        "embedded": len(embed),
+        "dropped": previous - len(kept),
+    }
+    return MmapVectorStore(vectors, doc_ids, ann_index, ann_meta, hashes), stats
+
+
+def sync_bm25_index(
+    bm25_index: Optional[BM25Index],
+    documents: List[Document],
+    hashes: npt.NDArray[np.bytes_],
+) -> Tuple[BM25Index, Dict[str, int]]:
+    """
+    Bring a BM25 index in line with the documents, by content hash (like
+    sync_vector_store): postings of unchanged documents are kept, only added or
+    changed documents are tokenized.
+    Returns the new (in memory) index and the counts of what changed.
+    """
+    return sync_index(bm25_index, [document.text for document in documents], hashes)
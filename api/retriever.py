@@ -1,30 +1,250 @@
-from typing import List
+import asyncio
+from typing import Callable, Dict, List, Optional, Sequence
 
-from llama_index.core.retrievers import BaseRetriever, VectorIndexRetriever
-from llama_index.core.schema import NodeWithScore, QueryType
-from llama_index.retrievers.bm25 import BM25Retriever
+import numpy as np
+import numpy.typing as npt
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import BaseNode, NodeWithScore, QueryBundle, QueryType
+
+from api.bm25_index import BM25Index
+from api.embeddings import CachedEmbedding
+from api.vector_store import MmapVectorStore
+from lib.metrics import timed
+
+# A fusion strategy merges ranked result lists (best first) into one ranked list,
+# weighing each list by the weight at the same position.
+Fusion = Callable[[Sequence[List[NodeWithScore]], Sequence[float]], List[NodeWithScore]]
+
+
+def reciprocal_rank_fusion(
+    results: Sequence[List[NodeWithScore]], weights: Sequence[float], k: int = 60
+) -> List[NodeWithScore]:
+    """
+    Score each node by sum(weight / (k + rank)) over the lists it appears in.
+    Only ranks are used, so score scales of the retrievers don't matter.
+    """
+    nodes: Dict[str, NodeWithScore] = {}
+    scores: Dict[str, float] = {}
+    for result, weight in zip(results, weights):
+        for rank, n in enumerate(result, start=1):
+            node_id = n.node.node_id
+            nodes.setdefault(node_id, n)
+            scores[node_id] = scores.get(node_id, 0.0) + weight / (k + rank)
+    return _ranked(nodes, scores)
+
+
+def min_max_fusion(
+    results: Sequence[List[NodeWithScore]], weights: Sequence[float]
+) -> List[NodeWithScore]:
+    """
+    Min-max normalize the scores of each list to 0..1 and sum them weighted.
+    Expects higher scores to be better in every list.
+    """
+    nodes: Dict[str, NodeWithScore] = {}
+    scores: Dict[str, float] = {}
+    for result, weight in zip(results, weights):
+        if not result:
+            continue
+        raw = [n.score or 0.0 for n in result]
+        lo, hi = min(raw), max(raw)
+        span = hi - lo
+        for n, score in zip(result, raw):
+            node_id = n.node.node_id
+            nodes.setdefault(node_id, n)
+            norm = (score - lo) / span if span > 0 else 1.0
+            scores[node_id] = scores.get(node_id, 0.0) + weight * norm
+    return _ranked(nodes, scores)
+
+
+fusions: Dict[str, Fusion] = {
+    "rrf": reciprocal_rank_fusion,
+    "linear": min_max_fusion,
+}
+
+
+def _ranked(
+    nodes: Dict[str, NodeWithScore], scores: Dict[str, float]
+) -> List[NodeWithScore]:
+    ranked = sorted(scores, key=lambda node_id: scores[node_id], reverse=True)
+    return [NodeWithScore(node=nodes[i].node, score=scores[i]) for i in ranked]
+
+
+def _distances_to_similarities(nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+    # the vector store returns L2 distances (lower is better), so flip them around
+    return [
+        NodeWithScore(node=n.node, score=1.0 / (1.0 + (n.score or 0.0))) for n in nodes
+    ]
+
+
+class VectorRetriever(BaseRetriever):
+    vector_store: MmapVectorStore
+    embed_model: CachedEmbedding
+    nodes: Sequence[BaseNode]
+    top_k: int
+    nprobe: Optional[int]
+    ef_search: Optional[int]
+    allowed: Optional[npt.NDArray[np.bool_]]
+
+    def __init__(
+        self,
+        vector_store: MmapVectorStore,
+        embed_model: CachedEmbedding,
+        nodes: Sequence[BaseNode],
+        top_k: int,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        allowed: Optional[npt.NDArray[np.bool_]] = None,
+    ):
+        """
+        Embeds the query and searches the vector store.
+        The nodes are indexed by json_doc_id, and get the L2 distance as score.
+        The nprobe/ef_search params tune the ANN index (if any) for this retriever.
+        When allowed (a mask over the json_doc_ids) is given, only those are searched.
+        """
+        self.vector_store = vector_store
+        self.embed_model = embed_model
+        self.nodes = nodes
+        self.top_k = top_k
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.allowed = allowed
+        super().__init__()
+
+    def _search_batch(self, embeddings: List[List[float]]) -> List[List[NodeWithScore]]:
+        # one (vectorized) search for all the queries
+        with timed("vector_search"):
+            distances, doc_ids = self.vector_store.search(
+                np.array(embeddings),
+                self.top_k,
+                nprobe=self.nprobe,
+                ef_search=self.ef_search,
+                allowed=self.allowed,
+            )
+        return [
+            [
+                NodeWithScore(node=self.nodes[doc_id], score=float(distance))
+                for distance, doc_id in zip(row_distances, row_doc_ids)
+                if doc_id >= 0
+            ]
+            for row_distances, row_doc_ids in zip(distances, doc_ids)
+        ]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with timed("embedding"):
+            embedding = self.embed_model.get_query_embedding(query_bundle.query_str)
+        return self._search_batch([embedding])[0]
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with timed("embedding"):
+            embedding = await self.embed_model.aget_query_embedding(
+                query_bundle.query_str
+            )
+        return self._search_batch([embedding])[0]
+
+    async def aretrieve_batch(self, queries: List[str]) -> List[List[NodeWithScore]]:
+        """Embeds all queries in one call, and searches them in one go."""
+        with timed("embedding"):
+            embeddings = await self.embed_model.aget_query_embedding_batch(queries)
+        return self._search_batch(embeddings)
+
+
+class BM25IndexRetriever(BaseRetriever):
+    bm25_index: BM25Index
+    nodes: Sequence[BaseNode]
+    top_k: int
+    allowed: Optional[npt.NDArray[np.bool_]]
+
+    def __init__(
+        self,
+        bm25_index: BM25Index,
+        nodes: Sequence[BaseNode],
+        top_k: int,
+        allowed: Optional[npt.NDArray[np.bool_]] = None,
+    ):
+        """
+        Searches the BM25 index, only nodes matching a query term are returned.
+        The nodes are indexed by json_doc_id, and get the BM25 score.
+        When allowed (a mask over the json_doc_ids) is given, only those are scored.
+        """
+        self.bm25_index = bm25_index
+        self.nodes = nodes
+        self.top_k = top_k
+        self.allowed = allowed
+        super().__init__()
+
+    def retrieve_batch(self, queries: List[str]) -> List[List[NodeWithScore]]:
+        """Scores all queries in one go."""
+        with timed("bm25"):
+            results = self.bm25_index.search(queries, self.top_k, self.allowed)
+        return [
+            [
+                NodeWithScore(node=self.nodes[doc], score=float(score))
+                for score, doc in zip(scores, docs)
+            ]
+            for scores, docs in results
+        ]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self.retrieve_batch([query_bundle.query_str])[0]
 
 
 class HybridRetriever(BaseRetriever):
-    vector_retriever: VectorIndexRetriever
-    bm25_retriever: BM25Retriever
+    vector_retriever: VectorRetriever
+    bm25_retriever: BM25IndexRetriever
+    top_k: Optional[int]
+    fusion: Fusion
+    weights: Sequence[float]
 
     def __init__(
-        self, vector_retriever: VectorIndexRetriever, bm25_retriever: BM25Retriever
+        self,
+        vector_retriever: VectorRetriever,
+        bm25_retriever: BM25IndexRetriever,
+        top_k: Optional[int] = None,
+        fusion: Fusion = reciprocal_rank_fusion,
+        weights: Sequence[float] = (1.0, 1.0),
     ):
+        """
+        Retrieves from both retrievers and fuses the results into one ranking.
+        The weights are given in (bm25, vector) order.
+        """
         self.vector_retriever = vector_retriever
         self.bm25_retriever = bm25_retriever
+        self.top_k = top_k
+        self.fusion = fusion
+        self.weights = weights
         super().__init__()
 
+    def _fuse(
+        self, bm25_nodes: List[NodeWithScore], vector_nodes: List[NodeWithScore]
+    ) -> List[NodeWithScore]:
+        # drop bm25 nodes that only match terms with a zero weight
+        with timed("fusion"):
+            results = [
+                [n for n in bm25_nodes if n.score][: self.top_k],
+                _distances_to_similarities(vector_nodes),
+            ]
+            return self.fusion(results, self.weights)[: self.top_k]
+
     def _retrieve(self, query_bundle: QueryType) -> List[NodeWithScore]:
         bm25_nodes = self.bm25_retriever.retrieve(query_bundle)
         vector_nodes = self.vector_retriever.retrieve(query_bundle)
+        return self._fuse(bm25_nodes, vector_nodes)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # bm25 is cpu bound, so run it in a thread while we await the embedding call
+        bm25_nodes, vector_nodes = await asyncio.gather(
+            asyncio.to_thread(self.bm25_retriever.retrieve, query_bundle),
+            self.vector_retriever.aretrieve(query_bundle),
+        )
+        return self._fuse(bm25_nodes, vector_nodes)
 
-        # combine the two lists of nodes
-        all_nodes: List[NodeWithScore] = []
-        node_ids = set()
-        for n in bm25_nodes + vector_nodes:
-            if n.node.node_id not in node_ids:
-                all_nodes.append(n)
-                node_ids.add(n.node.node_id)
-        return all_nodes
+    async def aretrieve_batch(self, queries: List[str]) -> List[List[NodeWithScore]]:
+        """Retrieves for many queries at once, returns a ranking per query."""
+        bm25_results, vector_results = await asyncio.gather(
+            asyncio.to_thread(self.bm25_retriever.retrieve_batch, queries),
+            self.vector_retriever.aretrieve_batch(queries),
+        )
+        return [
+            self._fuse(bm25_nodes, vector_nodes)
+            for bm25_nodes, vector_nodes in zip(bm25_results, vector_results)
+        ]
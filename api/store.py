@@ -1,27 +1,44 @@
-import json
+import asyncio
 import os
-from typing import Dict, List, Union
-
-import faiss
-import pandas as pd
-from llama_index.core.indices import load_index_from_storage
-from llama_index.core.indices.vector_store.base import VectorStoreIndex
-from llama_index.core.retrievers import VectorIndexRetriever
-from llama_index.core.schema import Document, NodeWithScore
-from llama_index.core.service_context import ServiceContext
-from llama_index.core.storage.storage_context import StorageContext
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.retrievers.bm25 import BM25Retriever
-from llama_index.vector_stores.faiss import FaissVectorStore
+import threading
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
 from pydantic import BaseModel
 
-from api.retriever import HybridRetriever
-from lib.cache import async_threadsafe_ttl_cache as cache
+from api.lookup import NameLookup
+from lib.cache import async_ttl_cache as cache
+from lib.cache import shared_backend
+from lib.metrics import timed
+from lib.text import normalize_query
+from lib.tracing import span
+
+if TYPE_CHECKING:
+    # heavy (llama_index, faiss, numpy), only imported once the engine is loaded
+    from llama_index.core.schema import NodeWithScore
+
+    from api.engine import RetrievalEngine
 
 allsides_file = "./data/allsides.com.json"
 mbfc_file = "./data/mediabiasfactcheck.com.json"
 csv_file = "./data/all.csv"
-persist_dir = "./db"
+# all.csv with the mbfc facts merged in (see api.pipeline)
+combined_file = "./data/combined.json"
+# the index must be built with the same embedding provider (see api.embeddings)
+persist_dir = os.environ.get("DB_DIR", "./db")
+dimensions = 3072
+# query time params for the ANN index built by api/build-index.py (if any)
+index_nprobe = int(os.environ.get("INDEX_NPROBE", "0")) or None
+index_ef_search = int(os.environ.get("INDEX_EF_SEARCH", "0")) or None
+# number of ranked candidates retrieved (and cached) per query, pages are sliced from it
+candidate_window = int(os.environ.get("MEDIA_CANDIDATE_WINDOW", "50"))
+# how the bm25 and vector results get fused: "rrf" (reciprocal rank) or "linear"
+fusion_mode = os.environ.get("FUSION_MODE", "rrf")
+# fusion weights in "bm25,vector" order
+fusion_weights = tuple(
+    float(w) for w in os.environ.get("FUSION_WEIGHTS", "1.0,1.0").split(",")
+)
+# seconds between checks for a new snapshot (by the api), 0 disables it
+reload_interval = float(os.environ.get("RELOAD_INTERVAL", "30"))
 
 
 class Media(BaseModel):
@@ -41,105 +58,97 @@ class Media(BaseModel):
     Credibility: Union[str, None]
 
 
-def _merge_facts(df: pd.DataFrame, facts: Dict[str, Dict[str, str]]) -> pd.DataFrame:
-    def merge_fact(row: pd.Series) -> pd.Series:
-        name = row["Name"].lower()
-        if name in facts:
-            fact = facts[name]
-            row["Bias"] = fact["bias"]
-            row["Profile"] = fact["profile"]
-            row["Factual"] = fact["factual"]
-            row["Credibility"] = fact["credibility"]
-        else:
-            print(f"Facts not found for {name}")
-        return row
-
-    return df.apply(merge_fact, axis=1)
-
-
-def _get_data() -> List[Dict[str, str]]:
-    combined = "data/combined.json"
-    if os.path.exists(combined):
-        with open(combined, encoding="utf-8") as f:
-            return json.load(f)
-    else:
-        # combine the data
-        raw = pd.read_csv(csv_file, na_filter=False)
-        with open(mbfc_file, encoding="utf-8") as f:
-            fact_list = json.load(f)
-        facts = {item["name"].lower(): item for item in fact_list}
-        df = _merge_facts(raw, facts)
-        data = df.where(pd.notnull(df), None).to_dict(orient="records")
-        # write json to file:
-        with open(combined, "w", encoding="utf-8") as f:
-            json.dump(data, f)
-        return data
-
-
-def _get_documents() -> List[Document]:
+# record fields that media can be filtered on (see MediaFilter), by filter name
+filter_fields = {"bias": "Bias", "factual": "Factual", "credibility": "Credibility"}
+# canonical form of a filter: (filter name, accepted values) pairs, sorted
+FilterKey = Tuple[Tuple[str, Tuple[str, ...]], ...]
+
+
+def filter_value(value: str) -> str:
+    """Filter values match case and whitespace insensitively (e.g. " credibility")."""
+    return " ".join(str(value).lower().split())
+
+
+class MediaFilter(BaseModel):
     """
-    Let's create custom documents from json to avoid cruft, to get more reliable scoring during retrieval.
-    We keep our own index to later map back to the original json dicts corresponding to the matching documents.
-    We are only interested in the following fields, so we just concat them into a single string:
-    - Name
-    - About
-    - Topics
+    Restricts media to those having one of the given values for each filter set,
+    e.g. bias=["left-center", "center"] and youtube=True (a Youtube channel).
     """
-    data = _get_data()
-    documents = []
-    # iterate over the list of data and keep track of the index
-    for i, item in enumerate(data):
-        # create a document with the index as id
-        document = Document(
-            metadata={"json_doc_id": i},
-            text=item["Name"] + "\n" + item["About"] + "\n" + item["Topics"],
-        )
-        # add the document to the list
-        documents.append(document)
-    return documents
-
-
-def _get_index() -> VectorStoreIndex:
-    exists = os.path.exists(persist_dir)
-    print("DB exists: " + str(exists))
-
-    d = 3072
-    embed_model = OpenAIEmbedding(model_name="text-embedding-3-large", dimensions=d)
-    service_context = ServiceContext.from_defaults(embed_model=embed_model)
-    index: VectorStoreIndex
-    if exists:
-        vector_store = FaissVectorStore.from_persist_dir(persist_dir)
-        storage_context = StorageContext.from_defaults(
-            vector_store=vector_store,
-            persist_dir=persist_dir,
-        )
-        index = load_index_from_storage(
-            storage_context=storage_context, service_context=service_context
-        )
-    else:
-        faiss_index = faiss.IndexFlatL2(d)
-        vector_store = FaissVectorStore(faiss_index=faiss_index)
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        documents = _get_documents()
-        index = VectorStoreIndex.from_documents(
-            documents, storage_context=storage_context, service_context=service_context
-        )
-        index.storage_context.persist(persist_dir=persist_dir)
-    return index
 
+    bias: Optional[List[str]] = None
+    factual: Optional[List[str]] = None
+    credibility: Optional[List[str]] = None
+    youtube: Optional[bool] = None
 
-def _get_retriever(top_k: int) -> HybridRetriever:
-    use_top_k = top_k * 2
-    index = _get_index()
-    bm25_retriever = BM25Retriever.from_defaults(
-        index=index, similarity_top_k=use_top_k
-    )
-    vector_retriever = VectorIndexRetriever(
-        index=index,
-        similarity_top_k=use_top_k,
-    )
-    hybrid_retriever = HybridRetriever(vector_retriever, bm25_retriever)
-    return hybrid_retriever
+    def key(self) -> FilterKey:
+        """The canonical (hashable) form, so equal filters share cached results."""
+        key = []
+        for name in filter_fields:
+            values = getattr(self, name)
+            if values:
+                key.append((name, tuple(sorted({filter_value(v) for v in values}))))
+        if self.youtube is not None:
+            key.append(("youtube", (str(self.youtube).lower(),)))
+        return tuple(sorted(key))
+
+
+class SnapshotError(Exception):
+    """The data and the index on disk don't belong together (e.g. halfway a rebuild)"""
+
+
+_engine: Optional["RetrievalEngine"] = None
+# reentrant, as get_engine loads the first engine while holding it
+_engine_lock = threading.RLock()
+
+
+def get_engine() -> "RetrievalEngine":
+    """
+    Get the resident engine, loading it on first use (e.g. when called from streamlit,
+    which does not run the api lifespan hook).
+    """
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                load_engine()
+    return _engine
+
+
+async def aget_engine() -> "RetrievalEngine":
+    """get_engine, loading the engine in a worker thread so the event loop isn't blocked."""
+    if _engine is None:
+        return await asyncio.to_thread(get_engine)
+    return _engine
+
+
+def engine_loaded() -> bool:
+    return _engine is not None
+
+
+def load_engine() -> "RetrievalEngine":
+    """
+    (Re)load the engine from the snapshot on disk and atomically swap it in.
+    Queries that already hold a reference to the old engine finish on it.
+    Raises a SnapshotError (and keeps the current engine) when data and index
+    don't match.
+    """
+    global _engine  # pylint: disable=global-statement
+    # pylint: disable-next=import-outside-toplevel
+    from api.engine import RetrievalEngine
+
+    with _engine_lock, timed("index_load"):
+        engine = RetrievalEngine()
+        _engine = engine
+    return engine
+
+
+def reload_engine_if_changed() -> Optional["RetrievalEngine"]:
+    """Load the snapshot on disk if it changed since the engine was loaded."""
+    # pylint: disable-next=import-outside-toplevel
+    from api.engine import snapshot_signature
+
+    if snapshot_signature() == get_engine().signature:
+        return None
+    return load_engine()
 
 
 # def _get_reranked_nodes(
@@ -153,58 +162,144 @@ def _get_retriever(top_k: int) -> HybridRetriever:
 #     return reranked_nodes
 
 
-def _extract_node_data(nodes: list[NodeWithScore]) -> list[Media]:
+def _doc_ids(nodes: list["NodeWithScore"]) -> List[int]:
     """
     We need to map the nodes back to the original json data.
     """
-    data = _get_data()
-    selection = []
-    for node in nodes:
-        item = data[node.metadata["json_doc_id"]]
-        selection.append(item)
-    return selection
-
-
-@cache(ttl=60 * 60 * 24)
-async def query_media(query: str, top_k: int = 5) -> list[Media]:
-    retriever = _get_retriever(top_k)
-    raw_nodes = await retriever.aretrieve(query)
+    return [node.metadata["json_doc_id"] for node in nodes]
+
+
+# keyed by the snapshot version, so a new snapshot doesn't get the old results
+# (the engine is passed as the "session", which the cache leaves out of the key)
+# the json_doc_ids are cached, the records (and their json) are in the engine
+@cache(ttl=60 * 60 * 24, maxsize=1024, backend=shared_backend)
+async def _query_media_ids(
+    version: str,
+    query: str,
+    window: int,
+    filter_key: FilterKey,
+    session: "RetrievalEngine",
+) -> List[int]:
+    engine = session
+    raw_nodes = await engine.retrieve((query, window, filter_key))
     # reranked_nodes = _get_reranked_nodes(raw_nodes, query, top_k)
-    reranked_nodes = raw_nodes[:top_k]
-    # sort response by score
-    nodes_sorted = sorted(reranked_nodes, key=lambda x: x.score, reverse=True)
-    data = _extract_node_data(nodes_sorted)
-    # print("Found results:")
-    # for item in data:
-    #     print("---------")
-    #     print("Name: " + item["Name"])
-    #     print("About: " + item["About"])
-    #     print("Topics: " + item["Topics"])
-    #     print("Youtube: " + item["Youtube"])
-    return data
-
-
-def query_allsides(query: str, limit: int = 5, offset: int = 0) -> List[Dict[str, str]]:
-    with open(allsides_file, encoding="utf-8") as f:
-        fact_list = json.load(f)
-    results = []
-    for item in fact_list:
-        if query.lower() in item["name"].lower():
-            results.append(item)
-    return results[offset : offset + limit]
+    # the fused nodes are already sorted by score
+    reranked_nodes = raw_nodes[:window]
+    return _doc_ids(reranked_nodes)
 
 
-def query_mediabiasfactcheck(
-    query: str, limit: int = 5, offset: int = 0
+async def _query_media_page(
+    query: str, top_k: int, offset: int, filters: Optional[MediaFilter]
+) -> Tuple["RetrievalEngine", List[int]]:
+    # the json_doc_ids of a page, and the engine they belong to
+    filter_key = filters.key() if filters is not None else ()
+    # the endpoints validate them, this keeps other callers to a proper slice
+    offset = max(0, offset)
+    end = offset + max(0, top_k)
+    # pages past the window get the smallest multiple of it that covers them
+    window = candidate_window * max(1, -(-end // candidate_window))
+    # the whole query runs on the engine we got here, even if a new one is swapped in
+    engine = await aget_engine()
+    with span("query_media", query=query, window=window):
+        doc_ids = await _query_media_ids(
+            engine.version,
+            normalize_query(query),
+            window,
+            filter_key,
+            session=engine,
+        )
+    return engine, doc_ids[offset:end]
+
+
+async def query_media(
+    query: str,
+    top_k: int = 5,
+    offset: int = 0,
+    filters: Optional[MediaFilter] = None,
 ) -> List[Dict[str, str]]:
-    with open(mbfc_file, encoding="utf-8") as f:
-        fact_list = json.load(f)
-    results = []
-    for item in fact_list:
-        if query.lower() in item["name"].lower():
-            if item["credibility"] in [
-                "medium credibility",
-                "high credibility",
-            ] or item["factual"] in ["factual", "mostly", "mixed"]:
-                results.append(item)
-    return results[offset : offset + limit]
+    """
+    Ranked media for a query, from offset to offset + top_k.
+    Retrieval runs once per normalized query, filter and candidate window, and pages
+    are sliced from that (cached) ranked list.
+    The filters restrict the retrieval itself (see RetrievalEngine.filter_mask), so
+    a page is full as long as enough media match them.
+    """
+    engine, doc_ids = await _query_media_page(query, top_k, offset, filters)
+    with timed("record_mapping"):
+        return [engine.data[i] for i in doc_ids]
+
+
+async def query_media_json(
+    query: str,
+    top_k: int = 5,
+    offset: int = 0,
+    filters: Optional[MediaFilter] = None,
+) -> List[bytes]:
+    """
+    query_media, returning the records as json (validated and encoded once, when
+    the engine is loaded) to be assembled into a response as is.
+    """
+    engine, doc_ids = await _query_media_page(query, top_k, offset, filters)
+    return [engine.encoded[i] for i in doc_ids]
+
+
+async def query_media_batch(
+    queries: List[str],
+    top_k: int = 5,
+    offset: int = 0,
+    filters: Optional[MediaFilter] = None,
+) -> List[List[Dict[str, str]]]:
+    """
+    query_media for many queries: the cache misses among them are retrieved
+    together, and queries that normalize the same are retrieved only once.
+    """
+    return list(
+        await asyncio.gather(
+            *(query_media(query, top_k, offset, filters) for query in queries)
+        )
+    )
+
+
+def _is_credible(item: Dict[str, str]) -> bool:
+    return item["credibility"] in [
+        "medium credibility",
+        "high credibility",
+    ] or item["factual"] in ["factual", "mostly", "mixed"]
+
+
+allsides_lookup = NameLookup(allsides_file)
+mbfc_lookup = NameLookup(mbfc_file, eligible=_is_credible)
+
+
+def query_allsides(
+    query: str, limit: int = 5, offset: int = 0, mode: str = "substring"
+) -> Sequence[Mapping[str, Union[str, float]]]:
+    if mode == "fuzzy":
+        return allsides_lookup.fuzzy_search(query, limit, offset)
+    return allsides_lookup.search(query, limit, offset)
+
+
+def query_mediabiasfactcheck(
+    query: str, limit: int = 5, offset: int = 0, mode: str = "substring"
+) -> Sequence[Mapping[str, Union[str, float]]]:
+    if mode == "fuzzy":
+        return mbfc_lookup.fuzzy_search(query, limit, offset)
+    return mbfc_lookup.search(query, limit, offset)
+
+
+def query_allsides_json(
+    query: str, limit: int = 5, offset: int = 0, mode: str = "substring"
+) -> List[bytes]:
+    """query_allsides, returning the json encoded records."""
+    if mode == "fuzzy":
+        return allsides_lookup.fuzzy_search_json(query, limit, offset)
+    return allsides_lookup.search_json(query, limit, offset)
+
+
+def query_mediabiasfactcheck_json(
+    query: str, limit: int = 5, offset: int = 0, mode: str = "substring"
+) -> List[bytes]:
+    """query_mediabiasfactcheck, returning the json encoded records."""
+    if mode == "fuzzy":
+        return mbfc_lookup.fuzzy_search_json(query, limit, offset)
+    return mbfc_lookup.search_json(query, limit, offset)
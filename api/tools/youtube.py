@@ -1,12 +1,45 @@
+import asyncio
 import json
+import logging
+import os
+import re
 import time
 import urllib.parse
-from typing import Dict, List, Union
+import weakref
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, MutableMapping, Type, Union
 
-import requests
+import httpx
 from pydantic import BaseModel
 
-from lib.cache import sync_threadsafe_ttl_cache as cache
+from lib.cache import async_ttl_cache as cache
+from lib.cache import shared_backend
+from lib.circuit_breaker import CircuitBreaker, RetryPolicy
+from lib.metrics import observe_stage, timed
+from lib.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# max concurrent requests per host (and size of the keep-alive pool)
+max_connections_per_host = int(os.environ.get("YOUTUBE_MAX_CONNECTIONS", "4"))
+retry_policy = RetryPolicy(
+    attempts=int(os.environ.get("YOUTUBE_RETRY_ATTEMPTS", "3")),
+    timeout=float(os.environ.get("YOUTUBE_TIMEOUT", "5")),
+)
+# channels that keep failing are skipped for a while
+breaker = CircuitBreaker(
+    threshold=int(os.environ.get("YOUTUBE_BREAKER_THRESHOLD", "3")),
+    cooldown=float(os.environ.get("YOUTUBE_BREAKER_COOLDOWN", "300")),
+)
+
+# clients and semaphores are bound to the event loop they were created in,
+# (streamlit runs a new loop for every rerun), so we keep them per loop
+_clients: MutableMapping[asyncio.AbstractEventLoop, httpx.AsyncClient] = (
+    weakref.WeakKeyDictionary()
+)
+_host_semaphores: MutableMapping[
+    asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]
+] = weakref.WeakKeyDictionary()
 
 
 class Video(BaseModel):
@@ -23,65 +56,214 @@ class Video(BaseModel):
     url_suffix: str
 
 
+_whitespace = re.compile(r"\s*")
+
+
+def _video_fields(
+    video_data: Dict[str, Any],
+) -> Dict[str, Union[str, List[str], int, None]]:
+    res: Dict[str, Union[str, List[str], int, None]] = {}
+    res["id"] = video_data.get("videoId", None)
+    res["thumbnails"] = [
+        thumb.get("url", None)
+        for thumb in video_data.get("thumbnail", {}).get("thumbnails", [{}])
+    ]
+    res["title"] = video_data.get("title", {}).get("runs", [{}])[0].get("text", None)
+    res["long_desc"] = (
+        video_data.get("descriptionSnippet", {}).get("runs", [{}])[0].get("text", None)
+    )
+    res["channel"] = (
+        video_data.get("longBylineText", {}).get("runs", [{}])[0].get("text", None)
+    )
+    res["duration"] = video_data.get("lengthText", {}).get("simpleText", 0)
+    res["views"] = video_data.get("viewCountText", {}).get("simpleText", 0)
+    res["publish_time"] = video_data.get("publishedTimeText", {}).get("simpleText", 0)
+    res["url_suffix"] = (
+        video_data.get("navigationEndpoint", {})
+        .get("commandMetadata", {})
+        .get("webCommandMetadata", {})
+        .get("url", None)
+    )
+    return res
+
+
+class VideoParser:
+    """
+    Incremental parser that picks the videoRenderer objects out of a channel search page,
+    fed chunk by chunk (e.g. while it's being downloaded).
+    Instead of parsing the whole ytInitialData blob, it looks for the search results tab
+    and then only decodes the videoRenderer objects, and stops after max_results of them.
+    Consumed input is dropped from the buffer as it goes.
+    """
+
+    data_marker = "ytInitialData"
+    tab_marker = '"expandableTabRenderer"'
+    video_marker = '"videoRenderer":'
+
+    def __init__(self, max_results: int) -> None:
+        self.max_results = int(max_results)
+        self.results: List[Dict[str, Union[str, List[str], int, None]]] = []
+        # whether we've seen ytInitialData, and the search results tab in it
+        self.found_data = False
+        self.found_tab = False
+        self._buffer = ""
+        self._decoder = json.JSONDecoder()
+
+    @property
+    def done(self) -> bool:
+        return len(self.results) >= self.max_results
+
+    def _skip_to(self, marker: str) -> bool:
+        # keep the tail, as the marker may be split over two chunks
+        i = self._buffer.find(marker)
+        if i == -1:
+            self._buffer = self._buffer[-len(marker) :]
+            return False
+        self._buffer = self._buffer[i + len(marker) :]
+        return True
+
+    def feed(self, chunk: str) -> bool:
+        """Feed the next chunk of the page, returns True when done."""
+        self._buffer += chunk
+        if not self.found_data:
+            self.found_data = self._skip_to(self.data_marker)
+            if not self.found_data:
+                return False
+        if not self.found_tab:
+            self.found_tab = self._skip_to(self.tab_marker)
+            if not self.found_tab:
+                return False
+        while not self.done:
+            i = self._buffer.find(self.video_marker)
+            if i == -1:
+                self._buffer = self._buffer[-len(self.video_marker) :]
+                return False
+            start = _whitespace.match(self._buffer, i + len(self.video_marker)).end()
+            try:
+                video_data, end = self._decoder.raw_decode(self._buffer, start)
+            except json.JSONDecodeError:
+                # the object is not complete yet, wait for more input
+                self._buffer = self._buffer[i:]
+                return False
+            self.results.append(_video_fields(video_data))
+            self._buffer = self._buffer[end:]
+        return True
+
+
+class UploadsParser(VideoParser):
+    """VideoParser for the videos tab of a channel (its uploads, newest first)"""
+
+    tab_marker = '"richGridRenderer"'
+
+
 def _parse_html(
     html: str, max_results: int
 ) -> List[Dict[str, Union[str, List[str], int, None]]]:
-    results: List[Dict[str, Union[str, List[str], int, None]]] = []
-    start = html.index("ytInitialData") + len("ytInitialData") + 3
-    end = html.index("};", start) + 1
-    json_str = html[start:end]
-    data = json.loads(json_str)
-    tab = None
-    for tab in data["contents"]["twoColumnBrowseResultsRenderer"]["tabs"]:
-        if "expandableTabRenderer" in tab.keys():
+    parser = VideoParser(max_results)
+    # feed it in chunks like a download, so the parser never copies the whole page
+    for i in range(0, len(html), 65536):
+        if parser.feed(html[i : i + 65536]):
             break
-    if tab is None:
-        return results
-    for contents in tab["expandableTabRenderer"]["content"]["sectionListRenderer"][
-        "contents"
-    ]:
-        for video in contents["itemSectionRenderer"]["contents"]:
-            res: Dict[str, Union[str, List[str], int, None]] = {}
-            if "videoRenderer" in video.keys() and len(results) < int(max_results):
-                video_data = video.get("videoRenderer", {})
-                res["id"] = video_data.get("videoId", None)
-                res["thumbnails"] = [
-                    thumb.get("url", None)
-                    for thumb in video_data.get("thumbnail", {}).get("thumbnails", [{}])
-                ]
-                res["title"] = (
-                    video_data.get("title", {}).get("runs", [[{}]])[0].get("text", None)
-                )
-                res["long_desc"] = (
-                    video_data.get("descriptionSnippet", {})
-                    .get("runs", [{}])[0]
-                    .get("text", None)
-                )
-                res["channel"] = (
-                    video_data.get("longBylineText", {})
-                    .get("runs", [[{}]])[0]
-                    .get("text", None)
-                )
-                res["duration"] = video_data.get("lengthText", {}).get("simpleText", 0)
-                res["views"] = video_data.get("viewCountText", {}).get("simpleText", 0)
-                res["publish_time"] = video_data.get("publishedTimeText", {}).get(
-                    "simpleText", 0
-                )
-                res["url_suffix"] = (
-                    video_data.get("navigationEndpoint", {})
-                    .get("commandMetadata", {})
-                    .get("webCommandMetadata", {})
-                    .get("url", None)
-                )
-                results.append(res)
-
-        if results:
-            return results
-    return results
+    return parser.results
 
 
-@cache(ttl=3600)
-def search_youtube_channel(
+def _get_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        limits = httpx.Limits(
+            max_connections=max_connections_per_host,
+            max_keepalive_connections=max_connections_per_host,
+        )
+        client = httpx.AsyncClient(limits=limits, follow_redirects=True)
+        _clients[loop] = client
+    return client
+
+
+async def close_clients() -> None:
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+@asynccontextmanager
+async def _stream(url: str, timeout: float) -> AsyncIterator[httpx.Response]:
+    # parsed like the client does, so a bad url raises an httpx.InvalidURL
+    host = httpx.URL(url).netloc.decode("ascii")
+    semaphores = _host_semaphores.setdefault(asyncio.get_running_loop(), {})
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(max_connections_per_host)
+    async with semaphores[host]:
+        async with _get_client().stream("GET", url, timeout=timeout) as response:
+            yield response
+
+
+class FetchError(Exception):
+    def __init__(self, status: str, attempts: int, detail: str = "") -> None:
+        super().__init__(f"{status} after {attempts} attempts: {detail}")
+        self.status = status
+        self.attempts = attempts
+        self.detail = detail
+
+
+class ChannelResult(BaseModel):
+    """Outcome of a channel search: status is "ok" or the reason it failed"""
+
+    channel_url: str
+    status: str
+    attempts: int = 0
+    detail: Union[str, None] = None
+    videos: List[Dict[str, Union[str, List[str], int, None]]] = []
+
+
+async def _fetch_videos(
+    url: str, max_results: int, parser_class: Type[VideoParser] = VideoParser
+) -> List[Dict[str, Union[str, List[str], int, None]]]:
+    """
+    Stream a channel search page through a VideoParser, and stop reading as soon as
+    we have max_results videos.
+    Retries timeouts, network errors, 429/5xx responses and pages without data
+    (e.g. consent or throttling pages). Any failure is raised as a FetchError.
+    """
+    status, detail = "", ""
+    for attempt in range(1, retry_policy.attempts + 1):
+        parser = parser_class(max_results)
+        parse_seconds = 0.0
+        try:
+            async with _stream(url, timeout=retry_policy.timeout) as response:
+                if response.status_code == 200:
+                    async for chunk in response.aiter_text():
+                        start = time.perf_counter()
+                        done = parser.feed(chunk)
+                        parse_seconds += time.perf_counter() - start
+                        if done:
+                            break
+        except httpx.TimeoutException as e:
+            status, detail = "timeout", repr(e)
+        except httpx.TransportError as e:
+            status, detail = "network_error", repr(e)
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            # e.g. undecodable content, a redirect loop or a bad url: a retry
+            # won't help (NB: InvalidURL is not an HTTPError)
+            raise FetchError("request_error", attempt, repr(e)) from e
+        else:
+            observe_stage("youtube_parse", parse_seconds)
+            if response.status_code == 200 and parser.found_data:
+                return parser.results
+            if response.status_code == 200:
+                status, detail = "no_data", "page has no ytInitialData"
+            else:
+                status, detail = "http_error", f"HTTP {response.status_code}"
+                if response.status_code != 429 and response.status_code < 500:
+                    raise FetchError(status, attempt, detail)
+        if attempt < retry_policy.attempts:
+            await asyncio.sleep(retry_policy.delay(attempt))
+    raise FetchError(status, retry_policy.attempts, detail)
+
+
+# channels without (recent) videos on a topic are checked again sooner
+@cache(ttl=3600, maxsize=4096, negative_ttl=900, backend=shared_backend)
+async def _search_youtube_channel(
     channel_url: str, search_terms: str, period_days: int, max_results: int
 ) -> List[Dict[str, Union[str, List[str], int, None]]]:
     # calculate day and month from today minus period_days:
@@ -96,17 +278,46 @@ def search_youtube_channel(
     )
     url = f"{channel_url}/search?hl=en&query={encoded_search}"
 
-    html = ""
-    nothing = False
-    while "ytInitialData" not in html:
-        response = requests.get(url)
-        if response.status_code != 200:
-            print(f"Failed to get search results for {search_terms} from {channel_url}")
-            nothing = True
-            break
-        html = response.text
-        time.sleep(0.1)
-    if nothing:
-        return []
-    results = _parse_html(html, max_results)
+    if not breaker.allow(channel_url):
+        raise FetchError("circuit_open", 0, "too many recent failures")
+    try:
+        with timed("youtube_fetch"):
+            results = await _fetch_videos(url, max_results)
+    except FetchError:
+        breaker.record_failure(channel_url)
+        raise
+    breaker.record_success(channel_url)
     return results
+
+
+async def search_youtube_channel(
+    channel_url: str, search_terms: str, period_days: int, max_results: int
+) -> ChannelResult:
+    """
+    Search a channel for videos. Failures are not cached (they're retried next time),
+    and are reported in the result instead of raised.
+    """
+    try:
+        with span("search_youtube_channel", channel=channel_url):
+            videos = await _search_youtube_channel(
+                channel_url, search_terms, period_days, max_results
+            )
+    except FetchError as e:
+        logger.warning("youtube channel search failed: %s: %s", channel_url, e)
+        return ChannelResult(
+            channel_url=channel_url,
+            status=e.status,
+            attempts=e.attempts,
+            detail=e.detail,
+        )
+    return ChannelResult(channel_url=channel_url, status="ok", videos=videos)
+
+
+async def fetch_channel_uploads(
+    channel_url: str, max_results: int
+) -> List[Dict[str, Union[str, List[str], int, None]]]:
+    """The most recent uploads of a channel, raises a FetchError when that fails."""
+    with timed("youtube_fetch"):
+        return await _fetch_videos(
+            f"{channel_url}/videos?hl=en", max_results, UploadsParser
+        )
@@ -0,0 +1,281 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import urllib.parse
+from collections import Counter
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from api.tools.youtube import FetchError, fetch_channel_uploads
+from lib.metrics import timed
+
+if TYPE_CHECKING:
+    # imported when (re)indexing, as it pulls in llama_index and faiss
+    from api.bm25_index import BM25Index
+
+logger = logging.getLogger(__name__)
+
+# seconds between refreshes of (the uploads of) a channel, 0 disables the catalog
+catalog_interval = float(os.environ.get("YOUTUBE_CATALOG_INTERVAL", "0"))
+# uploads kept per channel (the videos tab shows 30)
+catalog_videos = int(os.environ.get("YOUTUBE_CATALOG_VIDEOS", "30"))
+# min seconds between two catalog requests to the same host
+catalog_min_delay = float(os.environ.get("YOUTUBE_CATALOG_MIN_DELAY", "2"))
+catalog_dir = os.environ.get("YOUTUBE_CATALOG_DIR", "./cache/youtube_catalog")
+channels_file = "channels.json"
+
+Videos = List[Dict[str, Union[str, List[str], int, None]]]
+
+_age = re.compile(r"(\d+)\s+(second|minute|hour|day|week|month|year)s?\s+ago")
+_unit_seconds = {
+    "second": 1,
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+    "week": 7 * 86400,
+    "month": 30 * 86400,
+    "year": 365 * 86400,
+}
+
+
+def published_at(publish_time: str, fetched_at: float) -> float:
+    """
+    Estimated publish time of a video, from its relative one (e.g. "Streamed 3 days
+    ago") as seen at fetched_at. Anything else (e.g. a live stream) counts as new.
+    """
+    match = _age.search(publish_time)
+    if match is None:
+        return fetched_at
+    return fetched_at - int(match[1]) * _unit_seconds[match[2]]
+
+
+class _Snapshot:
+    """
+    The videos of all channels, newest first, with their publish time and channel
+    columns and a BM25 index over their titles and descriptions.
+    """
+
+    def __init__(
+        self,
+        videos: Videos,
+        published: npt.NDArray[np.float64],
+        channels: npt.NDArray[np.int32],
+        channel_ids: Dict[str, int],
+        bm25_index: Optional["BM25Index"],
+    ) -> None:
+        self.videos = videos
+        self.published = published
+        self.channels = channels
+        self.channel_ids = channel_ids
+        self.bm25_index = bm25_index
+        # the bm25 results per query, shared by the channels of a /youtube request
+        self._results: Dict[
+            str, Tuple[npt.NDArray[np.float32], npt.NDArray[np.int32]]
+        ] = {}
+
+    def matches(
+        self, query: str
+    ) -> Tuple[npt.NDArray[np.float32], npt.NDArray[np.int32]]:
+        """All videos matching the query as (scores, positions), best first."""
+        results = self._results.get(query)
+        if results is None:
+            results = self.bm25_index.search([query], len(self.videos))[0]
+            if len(self._results) >= 1024:
+                self._results.clear()
+            self._results[query] = results
+        return results
+
+
+def _index(
+    channels: Dict[str, Dict[str, Any]], bm25_index: Optional["BM25Index"]
+) -> _Snapshot:
+    # pylint: disable-next=import-outside-toplevel
+    from api.bm25_index import sync_index
+
+    rows: Dict[str, Tuple[float, str, Dict[str, Any]]] = {}
+    for url, entry in channels.items():
+        for video, published in zip(entry["videos"], entry["published"]):
+            rows.setdefault(str(video["id"]), (published, url, video))
+    # newest first, so a period is a prefix
+    ordered = sorted(rows.items(), key=lambda row: -row[1][0])
+    channel_ids = {url: i for i, url in enumerate(sorted(channels))}
+    texts = [
+        f"{video['title'] or ''}\n{video['long_desc'] or ''}"
+        for _, (_, _, video) in ordered
+    ]
+    hashes = np.array([video_id for video_id, _ in ordered], dtype="S32")
+    bm25_index, _ = sync_index(bm25_index, texts, hashes)
+    return _Snapshot(
+        [video for _, (_, _, video) in ordered],
+        np.array([published for _, (published, _, _) in ordered]),
+        np.array([channel_ids[url] for _, (_, url, _) in ordered], dtype=np.int32),
+        channel_ids,
+        bm25_index,
+    )
+
+
+class VideoCatalog:
+    """
+    The recent uploads of channels (see refresh_catalog), searchable by query and
+    period in a local index instead of scraping a channel search page per query.
+    A refreshed channel gets a new snapshot (only its new videos are tokenized),
+    which is swapped in for the searches.
+    """
+
+    def __init__(self, persist_dir: str) -> None:
+        self.persist_dir = persist_dir
+        # channel url -> {"fetched_at": time, "videos": [...], "published": [...]}
+        self.channels: Dict[str, Dict[str, Any]] = {}
+        # last refresh attempt per channel (also when it failed)
+        self.attempted: Dict[str, float] = {}
+        self._snapshot = _Snapshot([], np.empty(0), np.empty(0, np.int32), {}, None)
+        self._indexing = asyncio.Lock()
+
+    def load(self) -> None:
+        path = os.path.join(self.persist_dir, channels_file)
+        if not os.path.exists(path):
+            return
+        # pylint: disable-next=import-outside-toplevel
+        from api.bm25_index import BM25Index
+
+        with open(path, encoding="utf-8") as f:
+            self.channels = json.load(f)
+        self.attempted = {
+            url: entry["fetched_at"] for url, entry in self.channels.items()
+        }
+        bm25_index = None
+        if BM25Index.exists(self.persist_dir):
+            bm25_index = BM25Index.load(self.persist_dir)
+        self._snapshot = _index(self.channels, bm25_index)
+
+    def _persist(
+        self, channels: Dict[str, Dict[str, Any]], snapshot: _Snapshot
+    ) -> None:
+        os.makedirs(self.persist_dir, exist_ok=True)
+        path = os.path.join(self.persist_dir, channels_file)
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(channels, f)
+        os.replace(tmp_path, path)
+        if snapshot.bm25_index is not None:
+            snapshot.bm25_index.persist(self.persist_dir)
+
+    async def update(self, channel_url: str, videos: Videos, fetched_at: float) -> None:
+        """Replace the uploads of a channel, and swap in a new snapshot."""
+        async with self._indexing:
+            self.channels[channel_url] = {
+                "fetched_at": fetched_at,
+                "videos": videos,
+                "published": [
+                    published_at(str(video["publish_time"]), fetched_at)
+                    for video in videos
+                ],
+            }
+            # tokenizing is cpu bound, keep it off the event loop (working on a copy,
+            # as searches keep coming in)
+            channels = dict(self.channels)
+            snapshot = await asyncio.to_thread(
+                _index, channels, self._snapshot.bm25_index
+            )
+            self._snapshot = snapshot
+            await asyncio.to_thread(self._persist, channels, snapshot)
+
+    def is_due(self, channel_url: str, now: float) -> bool:
+        return self.attempted.get(channel_url, 0) + catalog_interval <= now
+
+    def search(
+        self, channel_url: str, query: str, period_days: int, max_results: int
+    ) -> Optional[Videos]:
+        """
+        The best matching uploads of a channel published in the last period_days,
+        or None when the catalog has no recent uploads of the channel.
+        """
+        entry = self.channels.get(channel_url)
+        now = time.time()
+        # uploads older than two refreshes are too stale to be trusted
+        if entry is None or entry["fetched_at"] < now - 2 * catalog_interval:
+            return None
+        snapshot = self._snapshot
+        channel_id = snapshot.channel_ids.get(channel_url)
+        if channel_id is None:
+            # fetched, but not indexed yet
+            return None
+        with timed("youtube_catalog"):
+            scores, positions = snapshot.matches(query)
+            # published is sorted descending, so the period is a prefix of the videos
+            in_period = np.searchsorted(
+                -snapshot.published, -(now - int(period_days) * 86400), side="right"
+            )
+            selected = positions[
+                (positions < in_period)
+                & (snapshot.channels[positions] == channel_id)
+                & (scores > 0)
+            ]
+            return [snapshot.videos[i] for i in selected[:max_results]]
+
+
+video_catalog = VideoCatalog(catalog_dir)
+
+
+def _host(url: str) -> str:
+    return urllib.parse.urlsplit(url).netloc
+
+
+async def _refresh_channel(catalog: VideoCatalog, channel_url: str) -> None:
+    try:
+        videos = await fetch_channel_uploads(channel_url, catalog_videos)
+    except FetchError as e:
+        # keep the uploads we have (until they get too stale), and retry next round
+        logger.warning("youtube catalog refresh failed: %s: %s", channel_url, e)
+        return
+    await catalog.update(channel_url, videos, time.time())
+
+
+async def refresh_catalog(
+    catalog: VideoCatalog, channel_urls: Callable[[], List[str]]
+) -> None:
+    """
+    Keep refreshing the uploads of the channels (as returned by channel_urls), each
+    every catalog_interval seconds, least recently refreshed first.
+    Refreshes of the channels on a host are staggered evenly over the interval,
+    channels that were never fetched go first, catalog_min_delay seconds apart
+    (the min for any two requests to a host).
+    """
+    next_request: Dict[str, float] = {}
+    refreshing: Dict[str, "asyncio.Task[None]"] = {}
+
+    def forget(url: str, _: "asyncio.Task[None]") -> None:
+        refreshing.pop(url, None)
+
+    try:
+        while True:
+            now = time.time()
+            urls = channel_urls()
+            per_host = Counter(_host(url) for url in urls)
+            due = sorted(
+                (url for url in urls if catalog.is_due(url, now)),
+                key=lambda url: catalog.attempted.get(url, 0),
+            )
+            for url in due:
+                host = _host(url)
+                if url in refreshing or next_request.get(host, 0) > now:
+                    continue
+                spacing = catalog_min_delay
+                if url in catalog.attempted:
+                    spacing = max(spacing, catalog_interval / per_host[host])
+                next_request[host] = now + spacing
+                catalog.attempted[url] = now
+                task = asyncio.create_task(_refresh_channel(catalog, url))
+                refreshing[url] = task
+                task.add_done_callback(partial(forget, url))
+            # check what is due every second (or more often with a smaller min delay)
+            await asyncio.sleep(min(catalog_min_delay, 1.0))
+    finally:
+        for task in list(refreshing.values()):
+            task.cancel()
@@ -0,0 +1,346 @@
+import json
+import os
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import faiss
+import numpy as np
+import numpy.typing as npt
+
+vectors_file = "vectors.npy"
+doc_ids_file = "doc_ids.npy"
+# optional content hash per row (see api.pipeline), to only re-embed what changed
+hashes_file = "hashes.npy"
+# optional ANN index (see build_ann_index) and its settings
+ann_index_file = "index.faiss"
+ann_meta_file = "index.json"
+# filtered searches over at most this many documents skip the ANN index, an exact
+# search over few rows is cheap and the index may not reach them all
+exact_search_max_allowed = 2048
+# all the files of a db
+db_files = [vectors_file, doc_ids_file, hashes_file, ann_index_file, ann_meta_file]
+# files written by the llama_index FaissVectorStore/StorageContext
+legacy_vector_store_file = "default__vector_store.json"
+legacy_index_store_file = "index_store.json"
+legacy_docstore_file = "docstore.json"
+
+
+class MmapVectorStore:
+    """
+    Vector store persisted in a compact binary format:
+    - vectors.npy: raw float32 matrix (one row per document), memory mapped read-only,
+      so all workers on a host share the same pages through the OS page cache
+    - doc_ids.npy: int32 array mapping each row to its json_doc_id
+    - hashes.npy (optional): content hash of the document of each row
+    - index.faiss + index.json (optional): an ANN index over the same rows
+    Without an ANN index, searching is exact (brute force L2) straight on the mapped vectors.
+    """
+
+    def __init__(
+        self,
+        vectors: npt.NDArray[np.float32],
+        doc_ids: npt.NDArray[np.int32],
+        ann_index: Optional[faiss.Index] = None,
+        ann_meta: Optional[Dict[str, Any]] = None,
+        hashes: Optional[npt.NDArray[np.bytes_]] = None,
+    ) -> None:
+        self.vectors = vectors
+        self.doc_ids = doc_ids
+        self.ann_index = ann_index
+        self.ann_meta = ann_meta or {}
+        self.hashes = hashes
+
+    @property
+    def dimensions(self) -> int:
+        return int(self.vectors.shape[1])
+
+    @classmethod
+    def exists(cls, persist_dir: str) -> bool:
+        return os.path.exists(os.path.join(persist_dir, vectors_file))
+
+    @classmethod
+    def load(cls, persist_dir: str) -> "MmapVectorStore":
+        vectors = np.load(os.path.join(persist_dir, vectors_file), mmap_mode="r")
+        doc_ids = np.load(os.path.join(persist_dir, doc_ids_file))
+        hashes = None
+        if os.path.exists(os.path.join(persist_dir, hashes_file)):
+            hashes = np.load(os.path.join(persist_dir, hashes_file))
+        if not os.path.exists(os.path.join(persist_dir, ann_index_file)):
+            return cls(vectors, doc_ids, hashes=hashes)
+        ann_index = faiss.read_index(
+            os.path.join(persist_dir, ann_index_file),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+        )
+        with open(os.path.join(persist_dir, ann_meta_file), encoding="utf-8") as f:
+            ann_meta = json.load(f)
+        return cls(vectors, doc_ids, ann_index, ann_meta, hashes)
+
+    def persist(self, persist_dir: str) -> None:
+        """
+        Files are written next to their destination and then moved in place,
+        so processes that still have the old files mapped keep reading valid data.
+        """
+        os.makedirs(persist_dir, exist_ok=True)
+        vectors = np.ascontiguousarray(self.vectors, dtype=np.float32)
+        doc_ids = np.asarray(self.doc_ids, dtype=np.int32)
+        _write(persist_dir, vectors_file, lambda path: np.save(path, vectors))
+        _write(persist_dir, doc_ids_file, lambda path: np.save(path, doc_ids))
+        if self.hashes is not None:
+            hashes = self.hashes
+            _write(persist_dir, hashes_file, lambda path: np.save(path, hashes))
+        if self.ann_index is None:
+            for file in [ann_index_file, ann_meta_file]:
+                if os.path.exists(os.path.join(persist_dir, file)):
+                    os.remove(os.path.join(persist_dir, file))
+            return
+        _write(
+            persist_dir,
+            ann_index_file,
+            lambda path: faiss.write_index(self.ann_index, path),
+        )
+        _write(persist_dir, ann_meta_file, lambda path: _dump_json(path, self.ann_meta))
+
+    def search(
+        self,
+        queries: npt.NDArray[np.float32],
+        k: int,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        allowed: Optional[npt.NDArray[np.bool_]] = None,
+    ) -> Tuple[npt.NDArray[np.float32], npt.NDArray[np.int64]]:
+        """
+        Search the k nearest vectors for each query (one per row).
+        Returns the (squared L2) distances and json_doc_ids, -1 where there are no more results.
+        The nprobe (IVF) and ef_search (HNSW) params only apply to an ANN index, and
+        are passed per search, so the shared index is never mutated.
+        When allowed (a mask over the json_doc_ids) is given, only those documents
+        are searched: both the exact search and the ANN index skip the others with an
+        ID selector (without copying the vectors of the allowed ones). An ANN index
+        only looks at part of the vectors (the probed lists, the visited part of the
+        graph), so it can come back short with few documents allowed: those queries
+        are searched exactly, as are all of them when at most
+        exact_search_max_allowed documents are allowed. So k results come back as
+        long as there are.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        rows_allowed = None if allowed is None else allowed[self.doc_ids]
+        if rows_allowed is None:
+            k = min(k, len(self.doc_ids))
+        else:
+            k = min(k, int(rows_allowed.sum()))
+        if k == 0:
+            return (
+                np.empty((len(queries), 0), dtype=np.float32),
+                np.empty((len(queries), 0), dtype=np.int64),
+            )
+        selector = None
+        if rows_allowed is not None:
+            # faiss reads bit i of the bitmap as bitmap[i >> 3] >> (i & 7), the
+            # selector only points into it, so it's kept alive until the search is done
+            bitmap = np.packbits(rows_allowed, bitorder="little")
+            selector = faiss.IDSelectorBitmap(len(rows_allowed), faiss.swig_ptr(bitmap))
+        if self.ann_index is None or (
+            rows_allowed is not None and rows_allowed.sum() <= exact_search_max_allowed
+        ):
+            distances, rows = self._exact_search(queries, k, selector)
+        else:
+            params = _search_params(self.ann_index, nprobe, ef_search, selector)
+            distances, rows = self.ann_index.search(
+                truncate(queries, self.ann_meta.get("dimensions")), k, params=params
+            )
+            short = (rows < 0).any(axis=1)
+            if short.any():
+                distances[short], rows[short] = self._exact_search(
+                    queries[short], k, selector
+                )
+        doc_ids = np.full(rows.shape, -1, dtype=np.int64)
+        found = rows >= 0
+        doc_ids[found] = self.doc_ids[rows[found]]
+        return distances, doc_ids
+
+    def _exact_search(
+        self,
+        queries: npt.NDArray[np.float32],
+        k: int,
+        selector: Optional[faiss.IDSelector],
+    ) -> Tuple[npt.NDArray[np.float32], npt.NDArray[np.int64]]:
+        # brute force on the mapped vectors, the (allowed) rows
+        if selector is None:
+            return faiss.knn(queries, self.vectors, k)
+        queries = np.ascontiguousarray(queries)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        rows = np.empty((len(queries), k), dtype=np.int64)
+        faiss.knn_L2sqr(
+            faiss.swig_ptr(queries),
+            faiss.swig_ptr(self.vectors),
+            self.dimensions,
+            len(queries),
+            len(self.vectors),
+            k,
+            faiss.swig_ptr(distances),
+            faiss.swig_ptr(rows),
+            None,
+            selector,
+        )
+        return distances, rows
+
+
+def _write(persist_dir: str, file: str, write: Callable[[str], None]) -> None:
+    path = os.path.join(persist_dir, file)
+    # keep the extension, np.save would add .npy otherwise
+    tmp_path = os.path.join(persist_dir, f".tmp.{os.getpid()}.{file}")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _dump_json(path: str, data: Any) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+
+def truncate(
+    vectors: npt.NDArray[np.float32], dimensions: Optional[int]
+) -> npt.NDArray[np.float32]:
+    """
+    Matryoshka style dimension reduction: keep the first dimensions and renormalize.
+    The text-embedding-3 models are trained so that such prefixes stay meaningful.
+    """
+    if not dimensions or dimensions >= vectors.shape[1]:
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+    truncated = np.array(vectors[:, :dimensions], dtype=np.float32)
+    faiss.normalize_L2(truncated)
+    return truncated
+
+
+def build_ann_index(
+    vectors: npt.NDArray[np.float32], factory: str, dimensions: Optional[int] = None
+) -> Tuple[faiss.Index, Dict[str, Any]]:
+    """
+    Train and fill an ANN index from a faiss index factory string, e.g.:
+    - "Flat": exact search (only useful combined with dimension truncation)
+    - "IVF256,Flat": inverted lists, needs training (~40 vectors per list)
+    - "HNSW32": graph based, no training
+    - "IVF256,PQ64": inverted lists with product quantized (compressed) vectors
+    Returns the index and the metadata to persist alongside it.
+    """
+    x = truncate(vectors, dimensions)
+    ann_index = faiss.index_factory(x.shape[1], factory)
+    if not ann_index.is_trained:
+        ann_index.train(x)
+    ann_index.add(x)
+    return ann_index, {"factory": factory, "dimensions": x.shape[1]}
+
+
+def update_ann_index(
+    ann_index: faiss.Index,
+    ann_meta: Dict[str, Any],
+    vectors: npt.NDArray[np.float32],
+    moved: npt.NDArray[np.int64],
+    added: npt.NDArray[np.int64],
+    max_drift: float = 0.2,
+) -> Optional[Tuple[faiss.Index, Dict[str, Any]]]:
+    """
+    Update an IVF index for new rows instead of retraining it: moved holds the new
+    row of each old row (-1 for the ones dropped), added the new rows to add from
+    vectors. The entries of the kept rows are copied over (with their new row as
+    id) and the added vectors are assigned to the trained lists.
+    The lists were trained on the vectors back then, so once the vectors added or
+    dropped since the last training are more than max_drift of them, None is
+    returned to have the index rebuilt (see build_ann_index), as are the other
+    indexes (an HNSW graph can't drop vectors, a Flat index has no training to
+    keep). The index itself is left alone, as it may be in use by searches.
+    """
+    ivf = faiss.try_extract_index_ivf(ann_index)
+    drift = ann_meta.get("drift", 0) + int((moved < 0).sum()) + len(added)
+    if ivf is None or drift > max_drift * len(vectors):
+        return None
+    # clone it without its lists (which can't be cloned when memory mapped),
+    # the old lists stay with the old index
+    lists, own_lists = ivf.invlists, ivf.own_invlists
+    empty = faiss.ArrayInvertedLists(ivf.nlist, ivf.code_size)
+    ivf.own_invlists = False
+    ivf.replace_invlists(empty, False)
+    try:
+        updated = faiss.clone_index(ann_index)
+    finally:
+        ivf.replace_invlists(lists, own_lists)
+    updated_ivf = faiss.extract_index_ivf(updated)
+    ntotal = 0
+    for list_no in range(ivf.nlist):
+        size = lists.list_size(list_no)
+        if size == 0:
+            continue
+        ids = moved[faiss.rev_swig_ptr(lists.get_ids(list_no), size)]
+        codes = faiss.rev_swig_ptr(lists.get_codes(list_no), size * ivf.code_size)
+        keep = ids >= 0
+        kept_ids = np.ascontiguousarray(ids[keep])
+        kept_codes = np.ascontiguousarray(
+            codes.reshape(size, ivf.code_size)[keep], dtype=np.uint8
+        )
+        updated_ivf.invlists.add_entries(
+            list_no,
+            len(kept_ids),
+            faiss.swig_ptr(kept_ids),
+            faiss.swig_ptr(kept_codes),
+        )
+        ntotal += len(kept_ids)
+    # also counted by a wrapping index (e.g. a PCA pre-transform)
+    updated_ivf.ntotal = updated.ntotal = ntotal
+    if len(added):
+        x = truncate(vectors[added], ann_meta.get("dimensions"))
+        updated.add_with_ids(x, np.ascontiguousarray(added, dtype=np.int64))
+    return updated, {**ann_meta, "drift": drift}
+
+
+def _search_params(
+    ann_index: faiss.Index,
+    nprobe: Optional[int],
+    ef_search: Optional[int],
+    selector: Optional[faiss.IDSelector] = None,
+) -> Optional[faiss.SearchParameters]:
+    # params left out fall back to the ones the index was saved with
+    # (the SWIG constructors take no keyword arguments, so they are set after)
+    ivf = faiss.try_extract_index_ivf(ann_index)
+    if ivf is not None and (nprobe or selector is not None):
+        params = faiss.SearchParametersIVF()
+        params.nprobe = nprobe or ivf.nprobe
+    elif isinstance(ann_index, faiss.IndexHNSW) and (ef_search or selector is not None):
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = ef_search or ann_index.hnsw.efSearch
+    elif selector is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+    if selector is not None:
+        params.sel = selector
+    return params
+
+
+def has_legacy_store(persist_dir: str) -> bool:
+    return os.path.exists(os.path.join(persist_dir, legacy_vector_store_file))
+
+
+def convert_legacy_store(persist_dir: str) -> MmapVectorStore:
+    """
+    Convert the JSON based llama_index storage (faiss index + docstore) in persist_dir
+    to an MmapVectorStore. The vectors are reconstructed from the flat faiss index,
+    so nothing needs to be embedded again.
+    """
+    faiss_index = faiss.read_index(os.path.join(persist_dir, legacy_vector_store_file))
+    vectors = faiss_index.reconstruct_n(0, faiss_index.ntotal)
+    with open(
+        os.path.join(persist_dir, legacy_index_store_file), encoding="utf-8"
+    ) as f:
+        index_store = json.load(f)["index_store/data"]
+    with open(os.path.join(persist_dir, legacy_docstore_file), encoding="utf-8") as f:
+        docstore = json.load(f)["docstore/data"]
+    # there is only one index in the store, mapping faiss row ids to node ids
+    index_struct = json.loads(next(iter(index_store.values()))["__data__"])
+    nodes_dict = index_struct["nodes_dict"]
+    doc_ids = np.array(
+        [
+            docstore[nodes_dict[str(i)]]["__data__"]["metadata"]["json_doc_id"]
+            for i in range(faiss_index.ntotal)
+        ],
+        dtype=np.int32,
+    )
+    return MmapVectorStore(vectors, doc_ids)
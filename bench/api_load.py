@@ -0,0 +1,243 @@
+#!.venv/bin/python
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from bench.youtube_fixtures import serve_youtube
+
+parser = argparse.ArgumentParser(
+    prog="api_load.py",
+    description="Offline benchmark of the api endpoints: cold start, latency, throughput and memory.",
+)
+parser.add_argument("--requests", help="Requests per endpoint", type=int, default=200)
+parser.add_argument(
+    "--concurrency", help="Requests in flight per endpoint", type=int, default=8
+)
+parser.add_argument(
+    "--queries",
+    help="Distinct queries per endpoint (the rest of the requests repeat them)",
+    type=int,
+    default=20,
+)
+parser.add_argument(
+    "--youtube-latency",
+    help="Latency (ms) of the youtube stand-in per page",
+    type=float,
+    default=20,
+)
+parser.add_argument(
+    "--warmup",
+    help="Untimed requests per endpoint before measuring (lazy loads, first calls)",
+    type=int,
+    default=3,
+)
+parser.add_argument("--seed", help="Seed for picking the queries", type=int, default=0)
+parser.add_argument("--out", help="Write the results as json to this file")
+parser.add_argument(
+    "--baseline", help="Results json of an earlier run to compare against"
+)
+parser.add_argument(
+    "--tolerance",
+    help="Allowed relative regression against the baseline",
+    type=float,
+    default=0.3,
+)
+
+api_key = "bench"
+youtube_host = "https://www.youtube.com"
+
+
+def _configure(workdir: str) -> None:
+    # everything offline and out of the way of a dev setup, before the api is imported
+    os.environ.update(
+        {
+            "API_KEY": api_key,
+            "EMBED_PROVIDER": "local",
+            "DB_DIR": os.path.join(workdir, "db"),
+            "EMBED_CACHE_FILE": os.path.join(workdir, "embeddings.sqlite"),
+            "CACHE_URL": "none",
+            "RELOAD_INTERVAL": "0",
+        }
+    )
+
+
+def _queries(args: argparse.Namespace) -> Dict[str, List[Dict[str, Any]]]:
+    """Request params per endpoint, taken from the data snapshots."""
+    rng = random.Random(args.seed)
+    with open("data/combined.json", encoding="utf-8") as f:
+        media = json.load(f)
+    topics = sorted(
+        {t.strip() for item in media for t in item["Topics"].split(",") if t.strip()}
+    )
+    names = {}
+    for site, file in [
+        ("allsides", "data/allsides.com.json"),
+        ("mediabiasfactcheck", "data/mediabiasfactcheck.com.json"),
+    ]:
+        with open(file, encoding="utf-8") as f:
+            records = json.load(f)
+        # partial names, like people type them
+        names[site] = [
+            record["name"][: max(3, len(record["name"]) // 2)]
+            for record in rng.sample(records, args.queries)
+        ]
+    picked = rng.sample(topics, args.queries)
+    return {
+        "/media": [{"query": topic} for topic in picked],
+        "/youtube": [{"query": topic, "max_channels": 3} for topic in picked],
+        "/allsides": [{"name": name} for name in names["allsides"]],
+        "/mediabiasfactcheck": [{"name": name} for name in names["mediabiasfactcheck"]],
+    }
+
+
+def _rss_mb() -> Dict[str, float]:
+    with open("/proc/self/statm", encoding="utf-8") as f:
+        rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {"rss_mb": round(rss / 2**20, 1), "peak_rss_mb": round(peak / 2**20, 1)}
+
+
+def _percentile(values: List[float], p: float) -> float:
+    ranked = sorted(values)
+    return ranked[min(len(ranked) - 1, int(p / 100 * len(ranked)))]
+
+
+async def _load(
+    client: Any, path: str, params: List[Dict[str, Any]], args: argparse.Namespace
+) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+    for i in range(args.warmup):
+        await client.get(path, params={**params[i % len(params)], "apikey": api_key})
+
+    async def request(i: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.get(
+                path, params={**params[i % len(params)], "apikey": api_key}
+            )
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": args.requests,
+        "errors": errors,
+        "p50_ms": round(_percentile(latencies, 50), 3),
+        "p95_ms": round(_percentile(latencies, 95), 3),
+        "p99_ms": round(_percentile(latencies, 99), 3),
+        "throughput_rps": round(args.requests / elapsed, 1),
+        **_rss_mb(),
+    }
+
+
+async def _run(args: argparse.Namespace) -> Dict[str, Any]:
+    # pylint: disable=import-outside-toplevel
+    import httpx
+
+    start = time.perf_counter()
+    import api.main
+    from api.store import get_engine
+
+    import_s = time.perf_counter() - start
+    # the engine's (heavy) imports are part of the warm up
+    start = time.perf_counter()
+    from api.engine import RetrievalEngine
+
+    import_s += time.perf_counter() - start
+
+    # build the (local) index up front (without loading it as the api's engine),
+    # so the cold start is a regular start
+    start = time.perf_counter()
+    RetrievalEngine()
+    build_s = time.perf_counter() - start
+
+    server, youtube_url = serve_youtube(args.youtube_latency)
+    results: Dict[str, Any] = {
+        "config": {k: v for k, v in vars(args).items() if k not in ["out", "baseline"]},
+        "build_s": round(build_s, 3),
+        "endpoints": {},
+    }
+    transport = httpx.ASGITransport(app=api.main.app)
+    start = time.perf_counter()
+    async with (
+        api.main.app.router.lifespan_context(api.main.app),
+        httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=60
+        ) as client,
+    ):
+        # the engine is loaded in the background, we're warm once it's ready
+        while (await client.get("/ready")).status_code != 200:
+            await asyncio.sleep(0.01)
+        results["cold_start_s"] = round(import_s + time.perf_counter() - start, 3)
+        results["startup"] = _rss_mb()
+        for item in get_engine().data:
+            item["Youtube"] = item["Youtube"].replace(youtube_host, youtube_url)
+        for path, params in _queries(args).items():
+            results["endpoints"][path] = await _load(client, path, params, args)
+            print(path, results["endpoints"][path])
+    server.shutdown()
+    return results
+
+
+def _regressions(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    found = []
+    if results["cold_start_s"] > baseline["cold_start_s"] * (1 + tolerance):
+        found.append(
+            f"cold start {results['cold_start_s']}s > {baseline['cold_start_s']}s"
+        )
+    for path, result in results["endpoints"].items():
+        before = baseline["endpoints"].get(path)
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            found.append(f"{path} p95 {result['p95_ms']} ms > {before['p95_ms']} ms")
+        if result["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            found.append(
+                f"{path} throughput {result['throughput_rps']} < {before['throughput_rps']} rps"
+            )
+        if result["errors"] > before["errors"]:
+            found.append(f"{path} errors {result['errors']} > {before['errors']}")
+    return found
+
+
+def main() -> None:
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        _configure(workdir)
+        results = asyncio.run(_run(args))
+    print(f"cold start {results['cold_start_s']}s, {results['startup']}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = _regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!.venv/bin/python
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Literal, Mapping, Optional, Sequence, Union
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+parser = argparse.ArgumentParser(
+    prog="json_response.py",
+    description=(
+        "Offline benchmark of the CPU time per request of the pre-encoded /media and"
+        " lookup responses, against validating and encoding them per request."
+    ),
+)
+parser.add_argument("--requests", help="Requests per endpoint", type=int, default=500)
+parser.add_argument(
+    "--rounds",
+    help="Rounds alternating the two paths (the fastest round of each counts)",
+    type=int,
+    default=5,
+)
+parser.add_argument("--limit", help="Records per response", type=int, default=20)
+parser.add_argument("--seed", help="Seed for picking the queries", type=int, default=0)
+parser.add_argument("--out", help="Write the results as json to this file")
+
+api_key = "bench"
+
+
+def _configure(workdir: str) -> None:
+    # everything offline and out of the way of a dev setup, before the api is imported
+    os.environ.update(
+        {
+            "API_KEY": api_key,
+            "EMBED_PROVIDER": "local",
+            "DB_DIR": os.path.join(workdir, "db"),
+            "EMBED_CACHE_FILE": os.path.join(workdir, "embeddings.sqlite"),
+            "CACHE_URL": "none",
+            "RELOAD_INTERVAL": "0",
+        }
+    )
+
+
+def _validated_app() -> Any:
+    """The endpoints as they were: records validated and encoded per request."""
+    # pylint: disable=import-outside-toplevel
+    from fastapi import Depends, FastAPI, Query
+
+    from api.store import (
+        Media,
+        MediaFilter,
+        query_allsides,
+        query_media,
+        query_mediabiasfactcheck,
+    )
+    from lib.auth import verify_apikey
+
+    app = FastAPI()
+
+    @app.get("/media", response_model=List[Media])
+    async def search_media(
+        query: str,
+        limit: int = 5,
+        offset: int = 0,
+        bias: Optional[List[str]] = Query(None),
+        factual: Optional[List[str]] = Query(None),
+        credibility: Optional[List[str]] = Query(None),
+        youtube: Optional[bool] = None,
+        _: None = Depends(verify_apikey),
+    ) -> List[Dict[str, str]]:
+        filters = MediaFilter(
+            bias=bias, factual=factual, credibility=credibility, youtube=youtube
+        )
+        return await query_media(query, top_k=limit, offset=offset, filters=filters)
+
+    @app.get("/allsides", response_model=List[Dict[str, Union[str, float]]])
+    def search_allsides(
+        name: str,
+        limit: int = 5,
+        offset: int = 0,
+        mode: Literal["substring", "fuzzy"] = "substring",
+        _: None = Depends(verify_apikey),
+    ) -> Sequence[Mapping[str, Union[str, float]]]:
+        return query_allsides(name, limit, offset, mode)
+
+    @app.get("/mediabiasfactcheck", response_model=List[Dict[str, Union[str, float]]])
+    def search_mediabiasfactcheck(
+        name: str,
+        limit: int = 5,
+        offset: int = 0,
+        mode: Literal["substring", "fuzzy"] = "substring",
+        _: None = Depends(verify_apikey),
+    ) -> Sequence[Mapping[str, Union[str, float]]]:
+        return query_mediabiasfactcheck(name, limit, offset, mode)
+
+    return app
+
+
+def _params(args: argparse.Namespace) -> Dict[str, List[Dict[str, Any]]]:
+    """Request params per endpoint, taken from the data snapshots."""
+    rng = random.Random(args.seed)
+    with open("data/combined.json", encoding="utf-8") as f:
+        media = json.load(f)
+    topics = sorted(
+        {t.strip() for item in media for t in item["Topics"].split(",") if t.strip()}
+    )
+    params: Dict[str, List[Dict[str, Any]]] = {
+        "/media": [
+            {"query": topic, "limit": args.limit} for topic in rng.sample(topics, 10)
+        ]
+    }
+    for site, file in [
+        ("allsides", "data/allsides.com.json"),
+        ("mediabiasfactcheck", "data/mediabiasfactcheck.com.json"),
+    ]:
+        with open(file, encoding="utf-8") as f:
+            records: List[Dict[str, str]] = json.load(f)
+        # (sampled by position, pylint takes the items of random.sample for None)
+        names = [records[i]["name"][:3] for i in rng.sample(range(len(records)), 10)]
+        for mode in ["substring", "fuzzy"]:
+            params[f"/{site}?mode={mode}"] = [
+                {"name": name, "limit": args.limit, "mode": mode} for name in names
+            ]
+    return params
+
+
+async def _cpu_per_request(
+    client: Any, path: str, params: List[Dict[str, Any]], requests: int
+) -> float:
+    """CPU time (us) per request, sequential so the time is all this request's."""
+    start = time.process_time()
+    for i in range(requests):
+        response = await client.get(
+            path, params={**params[i % len(params)], "apikey": api_key}
+        )
+        response.raise_for_status()
+    return (time.process_time() - start) / requests * 1e6
+
+
+async def _run(args: argparse.Namespace) -> Dict[str, Any]:
+    # pylint: disable=import-outside-toplevel
+    import httpx
+
+    import api.main
+
+    results: Dict[str, Any] = {
+        "config": {k: v for k, v in vars(args).items() if k != "out"}
+    }
+    apps = {"validated": _validated_app(), "pre_encoded": api.main.app}
+    async with api.main.app.router.lifespan_context(api.main.app):
+        await api.main.app.state.warm_up
+        clients = {
+            name: httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app), base_url="http://bench"
+            )
+            for name, app in apps.items()
+        }
+        for endpoint, params in _params(args).items():
+            path = endpoint.split("?", maxsplit=1)[0]
+            # both give the same bytes (and warm up the caches of /media)
+            for p in params:
+                bodies = [
+                    (await client.get(path, params={**p, "apikey": api_key})).content
+                    for client in clients.values()
+                ]
+                if bodies[0] != bodies[1]:
+                    raise AssertionError(f"{endpoint} {p}: the responses differ")
+            # alternated, so both see the same conditions (gc, cpu frequency)
+            rounds: Dict[str, List[float]] = {name: [] for name in clients}
+            for _ in range(args.rounds):
+                for name, client in clients.items():
+                    rounds[name].append(
+                        await _cpu_per_request(client, path, params, args.requests)
+                    )
+            cpu = {name: min(us) for name, us in rounds.items()}
+            results[endpoint] = {
+                **{f"{name}_cpu_us": round(us, 1) for name, us in cpu.items()},
+                "saved_cpu_us": round(cpu["validated"] - cpu["pre_encoded"], 1),
+                "saved_pct": round(
+                    100 * (1 - cpu["pre_encoded"] / cpu["validated"]), 1
+                ),
+            }
+            print(endpoint, results[endpoint])
+        for client in clients.values():
+            await client.aclose()
+    return results
+
+
+def main() -> None:
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        _configure(workdir)
+        results = asyncio.run(_run(args))
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
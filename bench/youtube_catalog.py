@@ -0,0 +1,128 @@
+#!.venv/bin/python
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from bench.youtube_fixtures import serve_youtube
+
+parser = argparse.ArgumentParser(
+    prog="youtube_catalog.py",
+    description="Offline benchmark of /youtube channel searches from the video catalog against live scraping.",
+)
+parser.add_argument("--channels", help="Channels in the catalog", type=int, default=80)
+parser.add_argument(
+    "--queries",
+    help="Distinct queries (each searched in 8 channels)",
+    type=int,
+    default=50,
+)
+parser.add_argument(
+    "--youtube-latency",
+    help="Latency (ms) of the youtube stand-in per page",
+    type=float,
+    default=20,
+)
+parser.add_argument(
+    "--min-delay",
+    help="Min seconds between catalog requests to the stand-in",
+    type=float,
+    default=0.01,
+)
+parser.add_argument("--seed", help="Seed for picking the queries", type=int, default=0)
+parser.add_argument("--out", help="Write the results as json to this file")
+
+
+def _configure(workdir: str, args: argparse.Namespace) -> None:
+    # offline and out of the way of a dev setup, before the api is imported
+    os.environ.update(
+        {
+            "CACHE_URL": "none",
+            "YOUTUBE_CATALOG_INTERVAL": "3600",
+            "YOUTUBE_CATALOG_MIN_DELAY": str(args.min_delay),
+            "YOUTUBE_CATALOG_DIR": os.path.join(workdir, "catalog"),
+        }
+    )
+
+
+def _summary(latencies: List[float]) -> Dict[str, float]:
+    ranked = sorted(latencies)
+    return {
+        "p50_ms": round(ranked[len(ranked) // 2], 3),
+        "p95_ms": round(ranked[min(len(ranked) - 1, int(0.95 * len(ranked)))], 3),
+    }
+
+
+async def _run(args: argparse.Namespace) -> Dict[str, Any]:
+    # pylint: disable=import-outside-toplevel
+    from api.tools.youtube import close_clients, search_youtube_channel
+    from api.tools.youtube_catalog import refresh_catalog, video_catalog
+
+    server, youtube_url = serve_youtube(args.youtube_latency)
+    channels = [f"{youtube_url}/channel{i}" for i in range(args.channels)]
+    results: Dict[str, Any] = {
+        "config": {k: v for k, v in vars(args).items() if k != "out"}
+    }
+
+    start = time.perf_counter()
+    refresher = asyncio.create_task(refresh_catalog(video_catalog, lambda: channels))
+    while len(video_catalog.channels) < len(channels):
+        await asyncio.sleep(0.01)
+    results["fill_s"] = round(time.perf_counter() - start, 3)
+    refresher.cancel()
+    print(f"catalog of {len(channels)} channels filled in {results['fill_s']}s")
+
+    # the generated titles are "<channel> on topic <n>"
+    rng = random.Random(args.seed)
+    queries = [f"topic {n}" for n in rng.sample(range(100), args.queries)]
+    for name in ["catalog", "live"]:
+        latencies = []
+        found = 0
+        for query in queries:
+            picked = rng.sample(channels, 8)
+            start = time.perf_counter()
+            if name == "catalog":
+                videos = [
+                    video_catalog.search(channel, query, 7, 3) or []
+                    for channel in picked
+                ]
+            else:
+                videos = [
+                    result.videos
+                    for result in await asyncio.gather(
+                        *(
+                            search_youtube_channel(channel, query, 7, 3)
+                            for channel in picked
+                        )
+                    )
+                ]
+            latencies.append((time.perf_counter() - start) * 1000)
+            found += sum(len(v) for v in videos)
+        results[name] = {**_summary(latencies), "videos_found": found}
+        print(name, results[name])
+    await close_clients()
+    server.shutdown()
+    return results
+
+
+def main() -> None:
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        _configure(workdir, args)
+        results = asyncio.run(_run(args))
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import glob
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures", "youtube")
+
+
+def _video_renderer(
+    channel: str, i: int, rng: random.Random, published: str = ""
+) -> Dict[str, Any]:
+    # unique across channels (youtube ids are 11 characters)
+    channel_hash = zlib.crc32(channel.encode("utf-8"))
+    video_id = f"{channel_hash:08x}{i:03d}"
+    return {
+        "videoRenderer": {
+            "videoId": video_id,
+            "thumbnail": {
+                "thumbnails": [
+                    {"url": f"https://i.ytimg.com/vi/{video_id}/hq{size}.jpg"}
+                    for size in ["default", "720"]
+                ]
+            },
+            "title": {"runs": [{"text": f"{channel} on topic {rng.randint(0, 99)}"}]},
+            "descriptionSnippet": {"runs": [{"text": "lorem ipsum " * 20}]},
+            "longBylineText": {"runs": [{"text": channel}]},
+            "lengthText": {
+                "simpleText": f"{rng.randint(1, 59)}:{rng.randint(0, 59):02d}"
+            },
+            "viewCountText": {"simpleText": f"{rng.randint(100, 99999)} views"},
+            "publishedTimeText": {
+                "simpleText": published or f"{rng.randint(1, 23)} hours ago"
+            },
+            "navigationEndpoint": {
+                "commandMetadata": {
+                    "webCommandMetadata": {"url": f"/watch?v={video_id}"}
+                }
+            },
+            # the real pages carry a lot more per video than we need
+            "ownerBadges": [{"metadataBadgeRenderer": {"tooltip": "Verified"}}] * 3,
+            "trackingParams": "x" * 300,
+        }
+    }
+
+
+def make_channel_page(
+    channel: str, n_videos: int = 30, padding_kb: int = 300, seed: int = 0
+) -> str:
+    """
+    Generate a channel search page shaped like the real ones: a ytInitialData blob
+    with a (unloaded) home tab, the search results tab holding the videoRenderers,
+    and lots of unrelated page model data around it. Like on the real pages, most of
+    the padding comes before the results (see _padded).
+    """
+    rng = random.Random(seed)
+    data = {
+        "responseContext": {"serviceTrackingParams": [{"params": ["p" * 100] * 50}]},
+        # banners, avatars, links and the tabs of the channel header
+        "header": {"c4TabbedHeaderRenderer": {"padding": ["h" * 1000] * 0}},
+        "contents": {
+            "twoColumnBrowseResultsRenderer": {
+                "tabs": [
+                    {"tabRenderer": {"title": "Home", "selected": False}},
+                    {"tabRenderer": {"title": "Videos", "selected": False}},
+                    {
+                        "expandableTabRenderer": {
+                            "selected": True,
+                            "content": {
+                                "sectionListRenderer": {
+                                    "contents": [
+                                        {
+                                            "itemSectionRenderer": {
+                                                "contents": [
+                                                    _video_renderer(channel, i, rng)
+                                                    for i in range(n_videos)
+                                                ]
+                                            }
+                                        }
+                                    ]
+                                }
+                            },
+                        }
+                    },
+                ]
+            }
+        },
+        "topbar": {"desktopTopbarRenderer": {"padding": ["y" * 1000] * 0}},
+    }
+    return _padded(data, padding_kb)
+
+
+def make_uploads_page(
+    channel: str, n_videos: int = 30, padding_kb: int = 300, seed: int = 0
+) -> str:
+    """
+    Generate the videos tab of a channel shaped like the real ones: the uploads
+    (newest first, spread over the last weeks) in a grid in the selected tab.
+    """
+    rng = random.Random(seed)
+    ages = sorted(rng.randint(1, 24 * 30) for _ in range(n_videos))
+    data = {
+        "header": {"c4TabbedHeaderRenderer": {"padding": ["h" * 1000] * 0}},
+        "contents": {
+            "twoColumnBrowseResultsRenderer": {
+                "tabs": [
+                    {"tabRenderer": {"title": "Home", "selected": False}},
+                    {
+                        "tabRenderer": {
+                            "title": "Videos",
+                            "selected": True,
+                            "content": {
+                                "richGridRenderer": {
+                                    "contents": [
+                                        {
+                                            "richItemRenderer": {
+                                                "content": _video_renderer(
+                                                    channel,
+                                                    i,
+                                                    rng,
+                                                    (
+                                                        f"{age // 24} days ago"
+                                                        if age >= 24
+                                                        else f"{age} hours ago"
+                                                    ),
+                                                )
+                                            }
+                                        }
+                                        for i, age in enumerate(ages)
+                                    ]
+                                }
+                            },
+                        }
+                    },
+                ]
+            }
+        },
+        "topbar": {"desktopTopbarRenderer": {"padding": ["y" * 1000] * 0}},
+    }
+    return _padded(data, padding_kb)
+
+
+def _padded(data: Dict[str, Any], padding_kb: int) -> str:
+    """
+    The page of the data with padding_kb of unrelated markup, spread like on the
+    real pages (which are mostly the same markup whatever the results):
+    - 45% before ytInitialData: the ytcfg config, inline styles and scripts
+    - 15% in ytInitialData before the results: the channel header
+    - 40% after the results: the topbar and microformat data, and the scripts
+      at the end of the page
+    """
+    before_kb, header_kb = padding_kb * 45 // 100, padding_kb * 15 // 100
+    data["header"]["c4TabbedHeaderRenderer"]["padding"] = ["h" * 1000] * header_kb
+    after_kb = padding_kb - before_kb - header_kb
+    # half of it in the page model, half in the scripts after it
+    data["topbar"]["desktopTopbarRenderer"]["padding"] = ["y" * 1000] * (after_kb // 2)
+    payload = json.dumps(data, separators=(",", ":"))
+    config = json.dumps(
+        {f"EXPERIMENT_FLAG_{i}": "c" * 80 for i in range(before_kb * 5)},
+        separators=(",", ":"),
+    )
+    return (
+        "<!DOCTYPE html><html><head>"
+        + f"<script>ytcfg.set({config});</script>"
+        + "<style>"
+        + ".ytd-app{display:block;}" * (before_kb * 20)
+        + "</style></head><body>"
+        + f"<script>var ytInitialData = {payload};</script>"
+        + "<script>"
+        + "var filler = 0;" * (after_kb * 1024 // 30)
+        + "</script>"
+        + '<script>window.ytInitialPlayerResponse = {"a": {"b": 1}};</script>'
+        + "</body></html>"
+    )
+
+
+def load_corpus() -> List[Tuple[str, str]]:
+    """
+    Saved pages in bench/fixtures/youtube/*.html (name, html),
+    or generated ones when none have been saved there.
+    """
+    pages = []
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, "*.html"))):
+        with open(path, encoding="utf-8") as f:
+            pages.append((os.path.basename(path), f.read()))
+    if not pages:
+        pages = [
+            (
+                f"generated-{n_videos}-{padding_kb}kb",
+                make_channel_page(f"channel{i}", n_videos, padding_kb, seed=i),
+            )
+            for i, (n_videos, padding_kb) in enumerate([(3, 100), (30, 300), (30, 800)])
+        ]
+    return pages
+
+
+def serve_youtube(latency_ms: float) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Stand-in for youtube.com: channel search pages are picked from the corpus (per
+    channel), and the videos tab of a channel is generated.
+    """
+    pages = [html.encode("utf-8") for _, html in load_corpus()]
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args: Any) -> None:
+            pass
+
+        def do_GET(self) -> None:  # pylint: disable=invalid-name
+            time.sleep(latency_ms / 1000)
+            channel, _, tab = self.path.partition("?")[0].strip("/").partition("/")
+            seed = zlib.crc32(channel.encode("utf-8"))
+            if tab == "videos":
+                body = make_uploads_page(channel, padding_kb=100, seed=seed).encode()
+            else:
+                body = pages[seed % len(pages)]
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stops reading once it has parsed enough videos
+                pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
@@ -0,0 +1,91 @@
+#!.venv/bin/python
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from api.tools.youtube import _parse_html, _video_fields
+from bench.youtube_fixtures import load_corpus
+
+parser = argparse.ArgumentParser(prog="youtube_parser.py")
+parser.add_argument(
+    "--max-results", help="Videos to extract per page", type=int, default=3
+)
+parser.add_argument("--repeat", help="Runs per page and parser", type=int, default=20)
+parser.add_argument(
+    "--out", help="Write the results as json to this file", default=None
+)
+
+
+def legacy_parse_html(html: str, max_results: int) -> List[Dict[str, Any]]:
+    """The previous parser: slices out and json.loads the whole ytInitialData blob."""
+    results: List[Dict[str, Any]] = []
+    start = html.index("ytInitialData") + len("ytInitialData") + 3
+    end = html.index("};", start) + 1
+    data = json.loads(html[start:end])
+    tab = None
+    for tab in data["contents"]["twoColumnBrowseResultsRenderer"]["tabs"]:
+        if "expandableTabRenderer" in tab.keys():
+            break
+    if tab is None:
+        return results
+    for contents in tab["expandableTabRenderer"]["content"]["sectionListRenderer"][
+        "contents"
+    ]:
+        for video in contents["itemSectionRenderer"]["contents"]:
+            if "videoRenderer" in video.keys() and len(results) < int(max_results):
+                results.append(_video_fields(video["videoRenderer"]))
+        if results:
+            return results
+    return results
+
+
+def _measure(
+    parse: Callable[[str, int], List[Dict[str, Any]]],
+    html: str,
+    args: argparse.Namespace,
+) -> Dict[str, float]:
+    start = time.process_time()
+    for _ in range(args.repeat):
+        parse(html, args.max_results)
+    cpu_ms = (time.process_time() - start) / args.repeat * 1000
+    tracemalloc.start()
+    parse(html, args.max_results)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"cpu_ms": round(cpu_ms, 3), "peak_kb": round(peak / 1024, 1)}
+
+
+def main() -> None:
+    args = parser.parse_args()
+
+    report = []
+    for name, html in load_corpus():
+        if _parse_html(html, args.max_results) != legacy_parse_html(
+            html, args.max_results
+        ):
+            print(f"{name}: parsers disagree!")
+            sys.exit(1)
+        legacy = _measure(legacy_parse_html, html, args)
+        streaming = _measure(_parse_html, html, args)
+        print(
+            f"{name} ({len(html) // 1024} KB): "
+            f"legacy {legacy['cpu_ms']} ms / {legacy['peak_kb']} KB peak, "
+            f"streaming {streaming['cpu_ms']} ms / {streaming['peak_kb']} KB peak"
+        )
+        report.append(
+            {"page": name, "size": len(html), "legacy": legacy, "streaming": streaming}
+        )
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 #!/usr/bin/env sh
 . .venv/bin/activate
 
-dirs="api lib pages"
+dirs="api bench lib pages"
 
 echo "Formatting all code"
 
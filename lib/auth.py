@@ -1,7 +1,13 @@
 import os
+from typing import Optional
 
 from fastapi import Depends, HTTPException
-from fastapi.security import APIKeyHeader, APIKeyQuery, HTTPBearer
+from fastapi.security import (
+    APIKeyHeader,
+    APIKeyQuery,
+    HTTPAuthorizationCredentials,
+    HTTPBearer,
+)
 
 query_scheme = APIKeyQuery(name="apikey", scheme_name="APIKeyQuery", auto_error=False)
 header_scheme = APIKeyHeader(
@@ -11,10 +17,12 @@ bearer_scheme = HTTPBearer(scheme_name="HTTPBearer", auto_error=False)
 
 
 def verify_apikey(
-    apikey_query: str = Depends(query_scheme),
-    apikey_header: str = Depends(header_scheme),
-    apikey_bearer: str = Depends(bearer_scheme),
+    apikey_query: Optional[str] = Depends(query_scheme),
+    apikey_header: Optional[str] = Depends(header_scheme),
+    apikey_bearer: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme),
 ) -> None:
-    apikey = apikey_query or apikey_header or apikey_bearer
+    apikey = apikey_query or apikey_header
+    if apikey is None and apikey_bearer is not None:
+        apikey = apikey_bearer.credentials
     if not apikey == os.environ["API_KEY"]:
         raise HTTPException(status_code=401, detail="Unauthorized")
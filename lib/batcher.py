@@ -0,0 +1,89 @@
+import asyncio
+import weakref
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Generic,
+    List,
+    MutableMapping,
+    Set,
+    TypeVar,
+)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class _Batch(Generic[T, R]):
+    __slots__ = ("items", "futures", "timer")
+
+    def __init__(self) -> None:
+        self.items: List[T] = []
+        self.futures: List["asyncio.Future[R]"] = []
+        self.timer: Any = None
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Collects concurrent calls (up to max_size of them) and runs them as one call to
+    func, which takes the list of items and returns a result per item (in the same
+    order). When no batch is running, a batch is run as soon as the event loop gets
+    to it, so a lone call isn't delayed but calls made together (e.g. gathered) are
+    batched. While a batch is running (under load), calls are collected for up to
+    max_delay seconds.
+    An exception raised by func is raised to every caller in the batch.
+    Batches are kept per event loop (streamlit runs a new loop for every rerun).
+    """
+
+    def __init__(
+        self,
+        func: Callable[[List[T]], Awaitable[List[R]]],
+        max_size: int = 64,
+        max_delay: float = 0.002,
+    ) -> None:
+        self.func = func
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._batches: MutableMapping[asyncio.AbstractEventLoop, _Batch[T, R]] = (
+            weakref.WeakKeyDictionary()
+        )
+        # keep references to the running batches, so they're not garbage collected
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    async def __call__(self, item: T) -> R:
+        loop = asyncio.get_running_loop()
+        batch = self._batches.get(loop)
+        if batch is None:
+            batch = self._batches[loop] = _Batch()
+            if any(task.get_loop() is loop for task in self._tasks):
+                batch.timer = loop.call_later(self.max_delay, self._flush, loop, batch)
+            else:
+                batch.timer = loop.call_soon(self._flush, loop, batch)
+        future: "asyncio.Future[R]" = loop.create_future()
+        batch.items.append(item)
+        batch.futures.append(future)
+        if len(batch.items) >= self.max_size:
+            batch.timer.cancel()
+            self._flush(loop, batch)
+        return await future
+
+    def _flush(self, loop: asyncio.AbstractEventLoop, batch: _Batch[T, R]) -> None:
+        if self._batches.get(loop) is batch:
+            del self._batches[loop]
+        task = loop.create_task(self._run(batch.items, batch.futures))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, items: List[T], futures: List["asyncio.Future[R]"]) -> None:
+        try:
+            results = await self.func(items)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            for future in futures:
+                # callers that were cancelled already have a done future
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
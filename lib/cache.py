@@ -1,49 +1,159 @@
-from typing import Any
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
 
-from cachetools import TTLCache
+from cachetools import LRUCache
 from cachetools.keys import hashkey
 
-from lib.parameterized_lock import parameterized_lock
+from lib.cache_backends import CacheBackend, dumps, get_backend, loads
 
+# second tier shared by the api caches (see lib.cache_backends.get_backend)
+shared_backend = get_backend(
+    os.environ.get("CACHE_URL", "sqlite:///./cache/results.sqlite")
+)
 
-def async_threadsafe_ttl_cache(func: Any = None, ttl: int = 60) -> Any:
-    cache: Any = TTLCache(maxsize=100, ttl=ttl)
+# stats of the async caches by function name (see lib.metrics)
+caches: Dict[str, Callable[[], Dict[str, int]]] = {}
 
-    def decorator(decorated_func: Any) -> Any:
-        async def wrapper(*args: Any, **kwargs: Any) -> Any:
-            # Does not use 'session' in the key
-            kwargs_for_key = {i: kwargs[i] for i in kwargs if i != "session"}
-            key = hashkey(*args, **kwargs_for_key)
-            if key in cache:
-                return cache[key]
-            with parameterized_lock(key):
-                if key in cache:
-                    return cache[key]
-                cache[key] = await decorated_func(*args, **kwargs)
-                return cache[key]
 
-        return wrapper
+class _LRUCache(LRUCache):
+    """LRUCache that counts its evictions"""
 
-    # Allows to call the decorator with or without parenthesis
-    return decorator(func) if callable(func) else decorator
+    def __init__(self, maxsize: int) -> None:
+        super().__init__(maxsize=maxsize)
+        self.evictions = 0
+
+    def popitem(self) -> Any:
+        self.evictions += 1
+        return super().popitem()
 
 
-def sync_threadsafe_ttl_cache(func: Any = None, ttl: int = 60) -> Any:
-    cache: Any = TTLCache(maxsize=100, ttl=ttl)
+class _Entry:
+    __slots__ = ("value", "expires", "refresh_at")
+
+    def __init__(self, value: Any, expires: float, refresh_at: float) -> None:
+        self.value = value
+        self.expires = expires
+        self.refresh_at = refresh_at
+
+
+def async_ttl_cache(
+    func: Any = None,
+    ttl: int = 60,
+    maxsize: int = 100,
+    negative_ttl: Optional[int] = None,
+    refresh_ratio: float = 0.9,
+    backend: Optional[CacheBackend] = None,
+) -> Any:
+    """
+    Asyncio native LRU cache with a ttl, that never blocks the event loop:
+    - single flight: concurrent callers missing on the same key await the same call
+    - stale while revalidate: an entry older than refresh_ratio * ttl is still served,
+      while it's refreshed in the background
+    - negative caching: empty results are kept for negative_ttl (defaults to ttl)
+    - exceptions are not cached
+    - an optional second tier backend (shared between workers and restarts) is
+      checked before calling the function, and gets its (json serialized) results
+    When the last caller waiting on a call is cancelled, the call is cancelled too.
+    Entries are shared by all threads, calls in flight only within their event loop
+    (e.g. streamlit runs a loop per session thread, and a task can't be awaited from
+    another loop).
+    """
+    cache = _LRUCache(maxsize=maxsize)
+    # guards the entries, which are used from all threads
+    lock = threading.Lock()
+    # calls in flight and their waiters, by (event loop, key)
+    in_flight: Dict[Any, "asyncio.Task[Any]"] = {}
+    waiters: Dict[Any, int] = {}
+    stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "refreshes": 0}
 
     def decorator(decorated_func: Any) -> Any:
-        def wrapper(*args: Any, **kwargs: Any) -> Any:
+        namespace = f"{decorated_func.__module__}.{decorated_func.__qualname__}"
+
+        def store(key: Any, value: Any, entry_ttl: float) -> None:
+            now = time.monotonic()
+            entry = _Entry(value, now + entry_ttl, now + entry_ttl * refresh_ratio)
+            with lock:
+                cache[key] = entry
+
+        async def load(key: Any, args: Any, kwargs: Any, refresh: bool) -> Any:
+            flight = (asyncio.get_running_loop(), key)
+            try:
+                if backend is not None:
+                    kwargs_for_key = sorted(
+                        (i, kwargs[i]) for i in kwargs if i != "session"
+                    )
+                    backend_key = namespace + dumps([args, kwargs_for_key]).decode()
+                    found = await asyncio.to_thread(backend.get, backend_key)
+                    # when refreshing, only take entries that are fresher than ours
+                    if found is not None and (
+                        not refresh or found[1] > ttl * (1 - refresh_ratio)
+                    ):
+                        stats["l2_hits"] += 1
+                        value = loads(found[0])
+                        store(key, value, found[1])
+                        return value
+                stats["misses"] += 1
+                value = await decorated_func(*args, **kwargs)
+                entry_ttl = ttl if value or negative_ttl is None else negative_ttl
+                store(key, value, entry_ttl)
+                if backend is not None:
+                    await asyncio.to_thread(
+                        backend.set, backend_key, dumps(value), entry_ttl
+                    )
+                return value
+            finally:
+                in_flight.pop(flight, None)
+
+        def start(
+            key: Any, args: Any, kwargs: Any, refresh: bool = False
+        ) -> "asyncio.Task[Any]":
+            task = asyncio.ensure_future(load(key, args, kwargs, refresh))
+            in_flight[(asyncio.get_running_loop(), key)] = task
+            return task
+
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
             # Does not use 'session' in the key
             kwargs_for_key = {i: kwargs[i] for i in kwargs if i != "session"}
             key = hashkey(*args, **kwargs_for_key)
-            if key in cache:
-                return cache[key]
-            with parameterized_lock(key):
-                if key in cache:
-                    return cache[key]
-                cache[key] = decorated_func(*args, **kwargs)
-                return cache[key]
+            flight = (asyncio.get_running_loop(), key)
+            with lock:
+                entry = cache.get(key)
+            now = time.monotonic()
+            if entry is not None and now < entry.expires:
+                stats["l1_hits"] += 1
+                if now >= entry.refresh_at and flight not in in_flight:
+                    stats["refreshes"] += 1
+                    # a failed refresh keeps serving the current entry until it expires
+                    start(key, args, kwargs, refresh=True).add_done_callback(
+                        lambda t: t.cancelled() or t.exception()
+                    )
+                return entry.value
+            task = in_flight.get(flight) or start(key, args, kwargs)
+            waiters[flight] = waiters.get(flight, 0) + 1
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if waiters[flight] == 1 and not task.done():
+                    task.cancel()
+                raise
+            finally:
+                waiters[flight] -= 1
+                if waiters[flight] == 0:
+                    del waiters[flight]
+
+        def snapshot() -> Dict[str, int]:
+            return {
+                **stats,
+                "evictions": cache.evictions,
+                "size": len(cache),
+                "in_flight": len(in_flight),
+            }
 
+        wrapper.cache_stats = stats  # type: ignore[attr-defined]
+        caches[namespace] = snapshot
         return wrapper
 
     # Allows to call the decorator with or without parenthesis
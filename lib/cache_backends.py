@@ -0,0 +1,124 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional, Tuple
+
+
+def dumps(value: Any) -> bytes:
+    """Compact, language neutral serialization (no pickles) for cached values."""
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def loads(data: bytes) -> Any:
+    return json.loads(data)
+
+
+class CacheBackend:
+    """
+    Interface of a second tier cache, shared between workers and restarts.
+    Values are passed as serialized bytes, keys are strings.
+    """
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        """Returns the value and its remaining ttl (seconds), or None."""
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        raise NotImplementedError
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Local on-disk backend, shared by all workers on the same host.
+    Expired entries are purged every `purge_every` writes.
+    """
+
+    def __init__(self, path: str, purge_every: int = 1000) -> None:
+        self.path = path
+        self.purge_every = purge_every
+        self._writes = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # connect lazily, so importing a decorated module has no side effects
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None, timeout=5
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache"
+                " (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute("SELECT value, expires FROM cache WHERE key = ?", (key,))
+                .fetchone()
+            )
+        if row is None:
+            return None
+        remaining = row[1] - time.time()
+        return (row[0], remaining) if remaining > 0 else None
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl),
+            )
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                conn.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+
+
+class RedisBackend(CacheBackend):
+    """
+    Network backend, shared by all workers on all hosts.
+    Needs the optional `redis` package.
+    """
+
+    def __init__(self, url: str) -> None:
+        try:
+            import redis  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise ImportError("Please install redis to use a redis:// cache") from e
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        pipe = self._client.pipeline()
+        pipe.get(key)
+        pipe.pttl(key)
+        value, pttl = pipe.execute()
+        if value is None or pttl <= 0:
+            return None
+        return value, pttl / 1000
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._client.set(key, value, px=int(ttl * 1000))
+
+
+def get_backend(url: str) -> Optional[CacheBackend]:
+    """
+    Create a backend from a url:
+    - "sqlite:///<path>" (eg. sqlite:///./cache/results.sqlite)
+    - "redis://<host>:<port>/<db>"
+    - "" or "none" for no second tier
+    """
+    if url in ["", "none"]:
+        return None
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///") :])
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported cache url: {url}")
@@ -0,0 +1,81 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Hashable
+
+
+class RetryPolicy:
+    """
+    Capped retries with exponential backoff and full jitter:
+    the delay before retry n is uniform in [0, min(max_delay, base_delay * 2^(n-1))].
+    """
+
+    def __init__(
+        self,
+        attempts: int = 3,
+        base_delay: float = 0.2,
+        max_delay: float = 2.0,
+        timeout: float = 5.0,
+    ) -> None:
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # per request timeout (seconds)
+        self.timeout = timeout
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+
+
+class CircuitBreaker:
+    """
+    Keeps a circuit per key (e.g. a channel url).
+    After `threshold` consecutive failures the circuit opens, and calls for that key
+    are short-circuited for `cooldown` seconds. After that a single trial call is let
+    through (half open): success closes the circuit, failure opens it again.
+    """
+
+    def __init__(
+        self,
+        threshold: int = 3,
+        cooldown: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self._failures: Dict[Hashable, int] = {}
+        self._opened_at: Dict[Hashable, float] = {}
+        self._lock = threading.Lock()
+
+    def state(self, key: Hashable) -> str:
+        with self._lock:
+            if self._failures.get(key, 0) < self.threshold:
+                return "closed"
+            if self.clock() - self._opened_at[key] < self.cooldown:
+                return "open"
+            return "half-open"
+
+    def allow(self, key: Hashable) -> bool:
+        with self._lock:
+            if self._failures.get(key, 0) < self.threshold:
+                return True
+            now = self.clock()
+            if now - self._opened_at[key] < self.cooldown:
+                return False
+            # half open: let this call through, but keep the others out for another cooldown
+            self._opened_at[key] = now
+            return True
+
+    def record_success(self, key: Hashable) -> None:
+        with self._lock:
+            self._failures.pop(key, None)
+            self._opened_at.pop(key, None)
+
+    def record_failure(self, key: Hashable) -> None:
+        with self._lock:
+            self._failures[key] = self._failures.get(key, 0) + 1
+            if self._failures[key] >= self.threshold:
+                self._opened_at[key] = self.clock()
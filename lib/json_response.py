@@ -0,0 +1,30 @@
+import json
+from typing import Any, Sequence
+
+from starlette.responses import JSONResponse
+
+
+def encode_json(content: Any) -> bytes:
+    """
+    Encoded exactly like fastapi's JSONResponse does (compact, utf-8), so responses
+    assembled from pre-encoded fragments are byte for byte the same.
+    """
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+class JSONFragmentsResponse(JSONResponse):
+    """
+    A json array of items that were encoded (see encode_json) ahead of time, e.g.
+    records encoded once at load time. The response is only concatenated, there is
+    no validation or encoding per request (like an orjson response, without orjson).
+    A JSONResponse, so the response_model of a route still documents it.
+    """
+
+    def render(self, content: Sequence[bytes]) -> bytes:
+        return b"[" + b",".join(content) + b"]"
@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, ContextManager, Dict, Iterator, List, Sequence, Tuple
+
+from lib.tracing import span
+
+# metrics are only collected (and /metrics is only served) when enabled
+enabled = os.environ.get("METRICS", "").lower() in ["1", "true", "yes"]
+
+# seconds, from sub millisecond stages up to slow youtube fetches
+default_buckets = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Histogram:
+    """Prometheus style histogram (cumulative buckets, sum and count) per label set"""
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = default_buckets,
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> (counts per bucket (last one is +Inf), sum)
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        with self._lock:
+            counts, total = self._series.setdefault(
+                label_values, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = {k: (list(c), t[0]) for k, (c, t) in self._series.items()}
+        for label_values, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip([*self.buckets, float("inf")], counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _labels([*self.label_names, "le"], [*label_values, le])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# A collector returns (name, type, description, {label values: value}, label names)
+# and is called when the metrics are rendered, e.g. to export existing counters.
+Sample = Tuple[str, str, str, Dict[Tuple[str, ...], float], Sequence[str]]
+_collectors: List[Callable[[], List[Sample]]] = []
+
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Request latency per endpoint",
+    ["method", "path", "status"],
+)
+stage_duration = Histogram(
+    "stage_duration_seconds", "Time spent per processing stage", ["stage"]
+)
+
+
+def register_collector(collector: Callable[[], List[Sample]]) -> None:
+    _collectors.append(collector)
+
+
+@contextmanager
+def _timer(stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        with span(stage):
+            yield
+    finally:
+        stage_duration.observe(time.perf_counter() - start, stage)
+
+
+def timed(stage: str) -> ContextManager[None]:
+    """
+    Time a stage (e.g. "bm25") for the metrics, and as a span of the current
+    request's trace (see lib.tracing). A no-op when both are disabled.
+    """
+    return _timer(stage) if enabled else span(stage)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """Record the time of a stage that was measured in parts."""
+    if enabled:
+        stage_duration.observe(seconds, stage)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = [*request_duration.render(), *stage_duration.render()]
+    for collector in _collectors:
+        for name, kind, description, samples, label_names in collector():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for label_values, value in sorted(samples.items()):
+                lines.append(f"{name}{_labels(label_names, label_values)} {value}")
+    return "\n".join(lines) + "\n"
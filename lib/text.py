@@ -0,0 +1,9 @@
+import unicodedata
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normalize free text input so that trivial variations map to the same key:
+    unicode compatibility form, casefolded and with collapsed whitespace.
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
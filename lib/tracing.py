@@ -0,0 +1,166 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# tracing is opt in, and costs a contextvar lookup per span when disabled
+enabled = os.environ.get("TRACING", "").lower() in ["1", "true", "yes"]
+# requests taking longer than this are logged with their spans
+slow_ms = float(os.environ.get("TRACE_SLOW_MS", "1000"))
+# fraction of requests (0..1) that get profiled, their profile is logged too
+profile_rate = float(os.environ.get("TRACE_PROFILE_RATE", "0"))
+# when set, the profiles are also dumped here as <trace_id>.prof (eg. for snakeviz)
+profile_dir = os.environ.get("TRACE_PROFILE_DIR", "")
+
+
+class Trace:
+    """
+    The spans of one request: name, start (from the start of the request) and
+    duration in ms, nesting depth and attributes
+    """
+
+    def __init__(self, trace_id: str) -> None:
+        self.trace_id = trace_id
+        self.start = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_depth: ContextVar[int] = ContextVar("depth", default=0)
+_disabled = nullcontext()
+# trace ids passed in are used in file names, so keep them simple
+_trace_id = re.compile(r"[\w-]{1,64}")
+# only one profiler can be active at a time
+_profiling = threading.Lock()
+
+
+@contextmanager
+def _span(trace: Trace, name: str, attrs: Dict[str, Any]) -> Iterator[None]:
+    depth = _depth.get()
+    token = _depth.set(depth + 1)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        _depth.reset(token)
+        # list.append is atomic, spans may come from worker threads
+        trace.spans.append(
+            {
+                "name": name,
+                "start_ms": round((start - trace.start) * 1000, 3),
+                "duration_ms": round((end - start) * 1000, 3),
+                "depth": depth,
+                **attrs,
+            }
+        )
+
+
+def span(name: str, **attrs: Any) -> ContextManager[None]:
+    """
+    Record a (nested) span in the trace of the current request, if any.
+    Asyncio tasks and to_thread calls inherit the trace of the code starting them.
+    """
+    trace = _trace.get()
+    if trace is None:
+        return _disabled
+    return _span(trace, name, attrs)
+
+
+def _profile_text(profile: cProfile.Profile, limit: int = 25) -> str:
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware giving each request a trace (id from the X-Trace-Id header, or
+    a new one), returned in the X-Trace-Id response header.
+    Requests slower than slow_ms are logged as json with their spans, and a sample
+    of requests is profiled with cProfile. NB: the profiler sees the whole thread, so
+    concurrent requests on the same event loop show up in the profile too.
+    """
+
+    def __init__(self, app: Callable[..., Any]) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        trace_id = headers.get(b"x-trace-id", b"").decode("latin-1")
+        if not _trace_id.fullmatch(trace_id):
+            trace_id = uuid.uuid4().hex[:16]
+        trace = Trace(trace_id)
+        token = _trace.set(trace)
+        status = 500
+
+        async def send_with_trace_id(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-trace-id", trace.trace_id.encode("latin-1")),
+                ]
+            await send(message)
+
+        profile = None
+        if profile_rate > 0 and random.random() < profile_rate:
+            if _profiling.acquire(blocking=False):
+                profile = cProfile.Profile()
+                profile.enable()
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            if profile is not None:
+                profile.disable()
+                _profiling.release()
+            _trace.reset(token)
+            self._report(scope, trace, status, profile)
+
+    def _report(
+        self,
+        scope: Dict[str, Any],
+        trace: Trace,
+        status: int,
+        profile: Optional[cProfile.Profile],
+    ) -> None:
+        duration_ms = (time.perf_counter() - trace.start) * 1000
+        if duration_ms < slow_ms and profile is None:
+            return
+        params = urllib.parse.parse_qsl(scope["query_string"].decode("latin-1"))
+        record: Dict[str, Any] = {
+            "trace_id": trace.trace_id,
+            "method": scope["method"],
+            "path": scope["path"],
+            # the api key can be passed as a query param, so leave it out
+            "params": {k: v for k, v in params if k != "apikey"},
+            "status": status,
+            "duration_ms": round(duration_ms, 3),
+            "slow": duration_ms >= slow_ms,
+            "spans": sorted(trace.spans, key=lambda s: s["start_ms"]),
+        }
+        if profile is not None:
+            record["profile"] = _profile_text(profile)
+            if profile_dir:
+                os.makedirs(profile_dir, exist_ok=True)
+                path = os.path.join(profile_dir, f"{trace.trace_id}.prof")
+                profile.dump_stats(path)
+                record["profile_file"] = path
+        logger.warning("trace %s", json.dumps(record))
@@ -2,7 +2,7 @@ import asyncio
 
 import streamlit as st
 
-from api.main import search_media
+from api.store import query_media
 
 st.sidebar.title("Indy News Search")
 st.title("Search media outlets by topic")
@@ -23,7 +23,7 @@ if query == "":
 
 
 async def search_and_display_results() -> None:
-    results = await search_media(query, limit=limit)
+    results = await query_media(query, top_k=limit)
     st.json(results, expanded=True)
 
 
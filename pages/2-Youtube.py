@@ -2,7 +2,7 @@ import asyncio
 
 import streamlit as st
 
-from api.main import search_youtube
+from api.main import stream_youtube
 
 st.sidebar.title("Indy News Search")
 st.title("Youtube overview by topic")
@@ -26,15 +26,18 @@ if query == "":
 
 
 async def get_youtube_results() -> None:
-    results = await search_youtube(
+    # render the videos of each channel as soon as they come in
+    async for event in stream_youtube(
         query, period_days, max_channels, max_videos_per_channel
-    )
-
-    for item in results:
-        #     st.markdown(
-        #         f"[{item['title']}](https://www.youtube.com{item['url_suffix']})",
-        #     )
-        st.video(f"https://www.youtube.com{item['url_suffix']}")
+    ):
+        if event["event"] == "summary":
+            st.caption(f"{event['video_count']} videos from {event['channels']} channels")
+            continue
+        for item in event["videos"]:
+            #     st.markdown(
+            #         f"[{item['title']}](https://www.youtube.com{item['url_suffix']})",
+            #     )
+            st.video(f"https://www.youtube.com{item['url_suffix']}")
 
 
 asyncio.run(get_youtube_results())
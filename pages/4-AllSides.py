@@ -1,6 +1,6 @@
 import streamlit as st
 
-from api.main import search_allsides
+from api.store import query_allsides
 
 st.sidebar.title("Indy News Search")
 st.title("Search AllSides DB")
@@ -14,13 +14,15 @@ Uses a snapshot of the AllSides DB (1604 records) and checks wether input is fou
 name = st.text_input("Search by name...", value="Democracy Now", max_chars=255)
 
 limit = st.slider("Select number of results", 1, 25, (5))
+fuzzy = st.checkbox("Typo tolerant (fuzzy) search")
 
 if name == "":
     st.stop()
 
 
 def search_and_display_results() -> None:
-    results = search_allsides(name, limit)
+    mode = "fuzzy" if fuzzy else "substring"
+    results = query_allsides(name, limit, mode=mode)
     st.json(results, expanded=True)
 
 
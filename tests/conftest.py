@@ -0,0 +1,15 @@
+import os
+import tempfile
+
+# everything offline and out of the way of a dev setup, before the api is imported
+_workdir = tempfile.mkdtemp(prefix="tests-")
+os.environ.update(
+    {
+        "API_KEY": "test",
+        "EMBED_PROVIDER": "local",
+        "DB_DIR": os.path.join(_workdir, "db"),
+        "EMBED_CACHE_FILE": os.path.join(_workdir, "embeddings.sqlite"),
+        "CACHE_URL": "none",
+        "RELOAD_INTERVAL": "0",
+    }
+)
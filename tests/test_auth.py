@@ -0,0 +1,41 @@
+from typing import Dict
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from lib.auth import verify_apikey
+
+app = FastAPI()
+
+
+@app.get("/private")
+def private(_: None = Depends(verify_apikey)) -> Dict[str, bool]:
+    return {"ok": True}
+
+
+client = TestClient(app)
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        {"params": {"apikey": "test"}},
+        {"headers": {"X-API-KEY": "test"}},
+        {"headers": {"Authorization": "Bearer test"}},
+    ],
+)
+def test_api_key_ways(key: Dict[str, Dict[str, str]]) -> None:
+    assert client.get("/private", **key).status_code == 200
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        {},
+        {"params": {"apikey": "wrong"}},
+        {"headers": {"Authorization": "Bearer wrong"}},
+    ],
+)
+def test_wrong_or_missing_api_key(key: Dict[str, Dict[str, str]]) -> None:
+    assert client.get("/private", **key).status_code == 401
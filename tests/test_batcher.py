@@ -0,0 +1,44 @@
+import asyncio
+import time
+from typing import List
+
+from lib.batcher import MicroBatcher
+
+
+def test_lone_call_is_not_delayed() -> None:
+    async def double(items: List[int]) -> List[int]:
+        return [2 * item for item in items]
+
+    batcher = MicroBatcher(double, max_delay=1.0)
+
+    async def call() -> float:
+        start = time.perf_counter()
+        assert await batcher(21) == 42
+        return time.perf_counter() - start
+
+    assert asyncio.run(call()) < 0.1
+
+
+def test_concurrent_calls_are_batched() -> None:
+    batches: List[List[int]] = []
+
+    async def record(items: List[int]) -> List[int]:
+        batches.append(items)
+        await asyncio.sleep(0.2)
+        return items
+
+    batcher = MicroBatcher(record, max_delay=0.1)
+
+    async def calls() -> None:
+        # gathered calls go in one batch
+        assert await asyncio.gather(*(batcher(i) for i in range(3))) == [0, 1, 2]
+        # calls arriving while a batch runs are collected into the next one
+        first = asyncio.ensure_future(batcher(3))
+        await asyncio.sleep(0.01)
+        later = [asyncio.ensure_future(batcher(i)) for i in [4, 5]]
+        await asyncio.sleep(0.02)
+        later.append(asyncio.ensure_future(batcher(6)))
+        assert await asyncio.gather(first, *later) == [3, 4, 5, 6]
+
+    asyncio.run(calls())
+    assert batches == [[0, 1, 2], [3], [4, 5, 6]]
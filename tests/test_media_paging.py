@@ -0,0 +1,48 @@
+# pylint: disable=protected-access
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api.main
+from api import store
+
+# no lifespan, the params are validated before the engine is needed
+client = TestClient(api.main.app)
+
+
+@pytest.mark.parametrize("paging", [{"limit": 0}, {"limit": -1}, {"offset": -1}])
+def test_media_rejects_bad_paging(paging: Dict[str, int]) -> None:
+    response = client.get(
+        "/media", params={"query": "climate", "apikey": "test", **paging}
+    )
+    assert response.status_code == 422
+    response = client.post(
+        "/media/batch",
+        json={"queries": ["climate"], **paging},
+        params={"apikey": "test"},
+    )
+    assert response.status_code == 422
+
+
+def test_query_media_page_clamps_paging(monkeypatch: pytest.MonkeyPatch) -> None:
+    engine = SimpleNamespace(version="test")
+
+    async def aget_engine() -> Any:
+        return engine
+
+    async def query_media_ids(*_: Any, **__: Any) -> List[int]:
+        return list(range(50))
+
+    monkeypatch.setattr(store, "aget_engine", aget_engine)
+    monkeypatch.setattr(store, "_query_media_ids", query_media_ids)
+
+    def page(top_k: int, offset: int) -> List[int]:
+        return asyncio.run(store._query_media_page("q", top_k, offset, None))[1]
+
+    assert page(-1, 0) == []
+    assert page(-1, 10) == []
+    assert page(3, -5) == [0, 1, 2]
+    assert page(3, 10) == [10, 11, 12]
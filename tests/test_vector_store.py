@@ -0,0 +1,70 @@
+import numpy as np
+import numpy.typing as npt
+import pytest
+
+import api.vector_store
+from api.vector_store import MmapVectorStore, build_ann_index, update_ann_index
+
+
+def _vectors(n: int, seed: int = 0) -> npt.NDArray[np.float32]:
+    return np.random.default_rng(seed).standard_normal((n, 16)).astype(np.float32)
+
+
+def test_update_ivf_index_keeps_its_training() -> None:
+    vectors = _vectors(2000)
+    ann_index, ann_meta = build_ann_index(vectors, "IVF16,Flat")
+    # drop the first 100 rows, move the rest up, and add 100 new ones at the end
+    new_vectors = np.concatenate([vectors[100:], _vectors(100, seed=1)])
+    moved = np.arange(-100, 1900, dtype=np.int64)
+    moved[:100] = -1
+    added = np.arange(1900, 2000, dtype=np.int64)
+    updated = update_ann_index(ann_index, ann_meta, new_vectors, moved, added)
+    assert updated is not None
+    updated_index, updated_meta = updated
+    assert updated_meta["drift"] == 200
+    assert ann_index.ntotal == 2000
+    # the same as the trained index filled with the new vectors
+    reference, _ = build_ann_index(vectors, "IVF16,Flat")
+    reference.reset()
+    reference.add(new_vectors)
+    queries = _vectors(10, seed=2)
+    distances, rows = updated_index.search(queries, 5)
+    expected_distances, expected_rows = reference.search(queries, 5)
+    assert np.array_equal(rows, expected_rows)
+    assert np.allclose(distances, expected_distances)
+
+
+def test_update_ann_index_rebuilds_on_drift_or_hnsw() -> None:
+    vectors = _vectors(1000)
+    moved = np.arange(1000, dtype=np.int64)
+    moved[:300] = -1
+    no_change = np.empty(0, dtype=np.int64)
+    ivf_index, ivf_meta = build_ann_index(vectors, "IVF8,Flat")
+    assert update_ann_index(ivf_index, ivf_meta, vectors, moved, no_change) is None
+    hnsw_index, hnsw_meta = build_ann_index(vectors, "HNSW16")
+    unchanged = np.arange(1000, dtype=np.int64)
+    assert (
+        update_ann_index(hnsw_index, hnsw_meta, vectors, unchanged, no_change) is None
+    )
+
+
+@pytest.mark.parametrize("factory", ["HNSW16", "IVF16,Flat"])
+def test_filtered_ann_search_finds_the_allowed_docs(
+    factory: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    vectors = _vectors(2000)
+    ann_index, ann_meta = build_ann_index(vectors, factory)
+    doc_ids = np.arange(2000, dtype=np.int32)[::-1].copy()
+    store = MmapVectorStore(vectors, doc_ids, ann_index, ann_meta)
+    allowed = np.zeros(2000, dtype=np.bool_)
+    allowed[[3, 500, 1200, 1999]] = True
+    queries = _vectors(5, seed=1)
+    expected_distances, expected_ids = store.search(queries, 10, allowed=allowed)
+    # without the shortcut to the exact search for few allowed docs
+    monkeypatch.setattr(api.vector_store, "exact_search_max_allowed", 0)
+    distances, ids = store.search(queries, 10, allowed=allowed)
+    assert ids.shape == (5, 4)
+    assert allowed[ids].all()
+    assert np.array_equal(np.sort(ids, axis=1), np.tile([3, 500, 1200, 1999], (5, 1)))
+    assert np.array_equal(ids, expected_ids)
+    assert np.allclose(distances, expected_distances)